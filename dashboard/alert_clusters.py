@@ -0,0 +1,75 @@
+"""
+Burst clustering of near-identical alerts
+
+The phone can fire many alerts for the same event (same device and event type
+a few seconds apart). Grouping them on ingest means the alert list, charts and
+LLM prompt handle one cluster per event instead of one entry per frame.
+"""
+
+from typing import Dict, List
+
+# Most severe verdict wins when a burst mixes operator answers
+VERDICT_SEVERITY = {"YES": 3, "MAYBE": 2, "NO": 1, "UNKNOWN": 0}
+
+
+def _finish_cluster(members: List[Dict]) -> Dict:
+    confidences = [m.get("modelConfidence") or 0 for m in members]
+
+    # Representative frame: highest confidence, latest on ties
+    representative = max(members, key=lambda m: (m.get("modelConfidence") or 0, m["ts"]))
+
+    # Per-verdict member counts, most severe first; totals are summed from these
+    tally: Dict[str, int] = {}
+    for m in members:
+        v = m.get("operatorVerdict", "UNKNOWN")
+        tally[v] = tally.get(v, 0) + 1
+    verdict_counts = dict(sorted(tally.items(), key=lambda kv: VERDICT_SEVERITY.get(kv[0], 0), reverse=True))
+    verdict = next(iter(verdict_counts))
+
+    cluster = dict(representative)
+    cluster.update({
+        "id": members[0].get("id", representative.get("id")),
+        "ts": members[-1]["ts"],
+        "operatorVerdict": verdict,
+        "verdictCounts": verdict_counts,
+        "count": len(members),
+        "firstTs": members[0]["ts"],
+        "lastTs": members[-1]["ts"],
+        "maxConfidence": max(confidences),
+        "meanConfidence": sum(confidences) / len(confidences),
+        "memberIds": [m.get("id") for m in members],
+    })
+    return cluster
+
+
+def cluster_alerts(alerts: List[Dict], gap_s: float = 10.0) -> List[Dict]:
+    """
+    Group alerts by (deviceId, eventType) where consecutive alerts are at most
+    gap_s apart. Each cluster looks like an alert (so existing rendering keeps
+    working) plus count/verdictCounts/firstTs/lastTs/maxConfidence/
+    meanConfidence/memberIds. operatorVerdict is the most severe member verdict;
+    verdictCounts says how many members gave each.
+
+    Returned newest first, matching the server's ordering.
+    """
+    if gap_s <= 0:
+        return [_finish_cluster([a]) for a in alerts]
+
+    gap_ms = gap_s * 1000
+    open_clusters: Dict[tuple, List[Dict]] = {}
+    clusters = []
+
+    for a in sorted(alerts, key=lambda a: a["ts"]):
+        key = (a.get("deviceId", "unknown"), a["eventType"])
+        members = open_clusters.get(key)
+
+        if members and a["ts"] - members[-1]["ts"] <= gap_ms:
+            members.append(a)
+        else:
+            if members:
+                clusters.append(_finish_cluster(members))
+            open_clusters[key] = [a]
+
+    clusters.extend(_finish_cluster(members) for members in open_clusters.values())
+    clusters.sort(key=lambda c: c["ts"], reverse=True)
+    return clusters
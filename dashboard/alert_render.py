@@ -0,0 +1,89 @@
+"""
+Batched, memoized HTML rendering for the alert list
+
+A whole page of alerts is emitted as one HTML block instead of an
+st.expander per alert, and each row's markup is cached by alert id and
+the fields it shows, so reruns without new alerts only join cached strings.
+This module is imported (not re-executed) by Streamlit, so the caches
+survive reruns.
+"""
+
+import html
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+# Same hues as COLORS in app.py
+VERDICT_STYLES = {
+    "YES": ("🚨", "#ef4444", "alert-high"),
+    "MAYBE": ("⚠️", "#f59e0b", "alert-medium"),
+}
+DEFAULT_STYLE = ("✅", "#10b981", "alert-low")
+
+
+def verdict_style(verdict: str) -> Tuple[str, str, str]:
+    """(badge, color, card class) for a verdict"""
+    return VERDICT_STYLES.get(verdict, DEFAULT_STYLE)
+
+
+@lru_cache(maxsize=4096)
+def format_ts(ts_ms: float, fmt: str = "%Y-%m-%d %H:%M:%S") -> str:
+    return datetime.fromtimestamp(ts_ms / 1000.0).strftime(fmt)
+
+
+def _row_key(a: Dict) -> tuple:
+    return (
+        a.get("id"),
+        a.get("count", 1),
+        a["ts"],
+        a.get("operatorVerdict", "UNKNOWN"),
+        a.get("modelConfidence") or 0,
+        a.get("deviceId", "unknown"),
+        a["eventType"],
+    )
+
+
+@lru_cache(maxsize=2048)
+def _row_html(alert_id, count: int, ts: float, verdict: str, conf: float, device: str, event_type: str) -> str:
+    badge, color, card_class = verdict_style(verdict)
+    burst = f' <span class="alert-burst">×{count}</span>' if count > 1 else ""
+
+    return (
+        f'<div class="alert-card {card_class}">'
+        f'<div class="alert-row">'
+        f'<span class="alert-title">{badge} {html.escape(event_type)}{burst}</span>'
+        f'<span class="alert-verdict" style="color: {color};">{html.escape(verdict)}</span>'
+        f'</div>'
+        f'<div class="alert-meta">📡 {html.escape(device)} · 🕒 {format_ts(ts)} · {conf:.2f}</div>'
+        f'<div class="confidence-bar"><div class="confidence-fill" style="width: {conf * 100:.0f}%; background: {color};"></div></div>'
+        f'</div>'
+    )
+
+
+def alert_row_html(a: Dict) -> str:
+    return _row_html(*_row_key(a))
+
+
+@lru_cache(maxsize=2048)
+def _label(alert_id, count: int, ts: float, verdict: str, conf: float, device: str, event_type: str) -> str:
+    badge, _, _ = verdict_style(verdict)
+    burst = f" ×{count}" if count > 1 else ""
+    return f"{badge} {event_type}{burst} - {verdict} - {format_ts(ts, '%H:%M:%S')} - {device}"
+
+
+def alert_label(a: Dict) -> str:
+    """Plain-text one-liner for selectors"""
+    return _label(*_row_key(a))
+
+
+def page_html(alerts: List[Dict]) -> str:
+    """One HTML block for a whole page of alerts"""
+    return '<div class="alert-list">' + "".join(alert_row_html(a) for a in alerts) + "</div>"
+
+
+def paginate(alerts: List[Dict], page: int, page_size: int) -> Tuple[List[Dict], int]:
+    """Return (alerts on `page` (1-based), number of pages)"""
+    n_pages = max(1, -(-len(alerts) // page_size))
+    page = min(max(page, 1), n_pages)
+    start = (page - 1) * page_size
+    return alerts[start:start + page_size], n_pages
@@ -0,0 +1,165 @@
+"""
+Incremental anomaly statistics per (deviceId, eventType)
+
+Each new alert updates a handful of NumPy slots in O(1): a fast and a slow
+EWMA of the alert rate, an EWMA variance of their gap (for a rolling
+z-score) and a run-length burst counter. Nothing is rescanned on rerun.
+"""
+
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+Key = Tuple[str, str]
+
+
+class StreamingAnomalyStats:
+    # Per-key state arrays, grown by doubling as new keys appear
+    _STATE = {
+        "last_ts": np.float64,
+        "rate_short": np.float64,
+        "rate_long": np.float64,
+        "var_long": np.float64,
+        "burst_len": np.int32,
+        "total": np.int64,
+    }
+
+    def __init__(self, short_halflife_s: float = 60.0, long_halflife_s: float = 1800.0,
+                 burst_gap_s: float = 10.0, burst_min: int = 3, z_threshold: float = 3.0,
+                 capacity: int = 64, max_seen_ids: int = 5000):
+        self.tau_short = short_halflife_s / np.log(2)
+        self.tau_long = long_halflife_s / np.log(2)
+        self.burst_gap_s = burst_gap_s
+        self.burst_min = burst_min
+        self.z_threshold = z_threshold
+        self.max_seen_ids = max_seen_ids
+
+        self.keys: List[Key] = []
+        self._index: Dict[Key, int] = {}
+        self._seen_ids: "OrderedDict[str, None]" = OrderedDict()
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        for name, dtype in self._STATE.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+
+    def _grow(self):
+        for name in self._STATE:
+            old = getattr(self, name)
+            new = np.zeros(len(old) * 2, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _slot(self, key: Key) -> int:
+        slot = self._index.get(key)
+        if slot is None:
+            slot = len(self.keys)
+            if slot == len(self.last_ts):
+                self._grow()
+            self.keys.append(key)
+            self._index[key] = slot
+        return slot
+
+    def update(self, alert: Dict) -> bool:
+        """Fold one alert into the statistics; returns False if already seen"""
+        alert_id = alert.get("id")
+        if alert_id is not None:
+            if alert_id in self._seen_ids:
+                return False
+            self._seen_ids[alert_id] = None
+            if len(self._seen_ids) > self.max_seen_ids:
+                self._seen_ids.popitem(last=False)
+
+        t = alert["ts"] / 1000.0
+        i = self._slot((alert.get("deviceId", "unknown"), alert["eventType"]))
+
+        if self.total[i] == 0:
+            dt = np.inf
+        else:
+            # Late arrivals count as simultaneous rather than rewinding time
+            dt = max(t - self.last_ts[i], 0.0)
+
+        decay_short = np.exp(-dt / self.tau_short)
+        decay_long = np.exp(-dt / self.tau_long)
+
+        # Rates are in alerts/min
+        self.rate_short[i] = self.rate_short[i] * decay_short + 60.0 / self.tau_short
+        self.rate_long[i] = self.rate_long[i] * decay_long + 60.0 / self.tau_long
+
+        deviation = self.rate_short[i] - self.rate_long[i]
+        self.var_long[i] = decay_long * self.var_long[i] + (1 - decay_long) * deviation ** 2
+
+        self.burst_len[i] = self.burst_len[i] + 1 if dt <= self.burst_gap_s else 1
+        self.last_ts[i] = max(self.last_ts[i], t)
+        self.total[i] += 1
+        return True
+
+    def update_many(self, alerts: List[Dict]) -> int:
+        """Fold in a batch of alerts (any order); returns how many were new"""
+        return sum(self.update(a) for a in sorted(alerts, key=lambda a: a["ts"]))
+
+    def snapshot(self, now_s: float) -> Dict[str, np.ndarray]:
+        """Rates, z-scores and burst flags decayed to `now_s`, vectorized over all keys"""
+        n = len(self.keys)
+        age = np.maximum(now_s - self.last_ts[:n], 0.0)
+
+        rate_short = self.rate_short[:n] * np.exp(-age / self.tau_short)
+        rate_long = self.rate_long[:n] * np.exp(-age / self.tau_long)
+
+        # Floor the spread at one alert per short window so a single new alert is not a spike
+        std = np.sqrt(self.var_long[:n])
+        std = np.maximum(std, np.maximum(rate_long, 60.0 / self.tau_short))
+        z = (rate_short - rate_long) / std
+
+        bursting = (self.burst_len[:n] >= self.burst_min) & (age <= self.burst_gap_s * 3)
+
+        return {
+            "rate_short": rate_short,
+            "rate_long": rate_long,
+            "z": z,
+            "bursting": bursting,
+            "burst_len": self.burst_len[:n],
+            "total": self.total[:n],
+        }
+
+    def top_anomalies(self, now_s: float, n: int = 5, only_flagged: bool = True) -> List[Dict]:
+        """Ranked "most anomalous right now" list"""
+        if not self.keys:
+            return []
+
+        snap = self.snapshot(now_s)
+        flagged = (snap["z"] >= self.z_threshold) | snap["bursting"]
+        candidates = np.flatnonzero(flagged) if only_flagged else np.arange(len(self.keys))
+        if candidates.size == 0:
+            return []
+
+        order = candidates[np.argsort(-snap["z"][candidates])][:n]
+
+        return [
+            {
+                "deviceId": self.keys[i][0],
+                "eventType": self.keys[i][1],
+                "rate_per_min": float(snap["rate_short"][i]),
+                "baseline_per_min": float(snap["rate_long"][i]),
+                "z": float(snap["z"][i]),
+                "bursting": bool(snap["bursting"][i]),
+                "burst_len": int(snap["burst_len"][i]),
+                "total": int(snap["total"][i]),
+            }
+            for i in order
+        ]
+
+
+def format_anomaly_lines(anomalies: List[Dict]) -> List[str]:
+    """Compact one-line-per-key description for prompts and the rule tier"""
+    lines = []
+    for a in anomalies:
+        line = (
+            f"- {a['deviceId']} | {a['eventType']} | {a['rate_per_min']:.1f}/min "
+            f"vs {a['baseline_per_min']:.1f}/min baseline | z={a['z']:.1f}"
+        )
+        if a["bursting"]:
+            line += f" | burst x{a['burst_len']}"
+        lines.append(line)
+    return lines
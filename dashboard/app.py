@@ -1,4 +1,6 @@
+import html
 import time
+import uuid
 import requests
 import streamlit as st
 from datetime import datetime, timedelta
@@ -6,9 +8,14 @@ from typing import Dict, List
 import plotly.graph_objects as go
 import plotly.express as px
 from collections import Counter
+from alert_clusters import cluster_alerts
+from alert_render import alert_label, format_ts, page_html, paginate, verdict_style
+from anomaly_stats import StreamingAnomalyStats, format_anomaly_lines
+from sharded_analysis import analyze_alerts_sharded, count_alerts, count_verdicts, format_alert_line, verdict_counts
 
 API_BASE = st.secrets.get("API_BASE", "http://localhost:8787")
 TOKEN = st.secrets.get("CAMPUSGUARD_TOKEN", "demo-token")
+DEVICE_ZONES = dict(st.secrets.get("DEVICE_ZONES", {}))
 
 st.set_page_config(
     page_title="CampusGuard Dashboard",
@@ -102,6 +109,37 @@ st.markdown(f"""
     .alert-medium {{ border-left-color: {COLORS['warning']}; }}
     .alert-low {{ border-left-color: {COLORS['success']}; }}
     
+    .alert-row {{
+        display: flex;
+        justify-content: space-between;
+        align-items: center;
+    }}
+    
+    .alert-title {{
+        font-weight: 600;
+        color: {COLORS['dark']};
+    }}
+    
+    .alert-verdict {{
+        font-weight: 700;
+        font-size: 0.75rem;
+        letter-spacing: 0.05em;
+    }}
+    
+    .alert-burst {{
+        background: {COLORS['light']};
+        color: {COLORS['primary']};
+        border-radius: 10px;
+        padding: 2px 8px;
+        font-size: 0.75rem;
+    }}
+    
+    .alert-meta {{
+        font-size: 0.8rem;
+        color: #6b7280;
+        margin-top: 4px;
+    }}
+    
     /* Threat level badges */
     .threat-badge {{
         display: inline-block;
@@ -229,7 +267,8 @@ with col_status:
     try:
         from npu_llm_engine import get_npu_engine
         engine = get_npu_engine()
-        provider = engine.session.get_providers()[0]
+        engine_status = engine.get_status()
+        provider = engine_status["provider"]
         
         if provider == 'DmlExecutionProvider':
             st.markdown(
@@ -247,6 +286,11 @@ with col_status:
                 '</div>',
                 unsafe_allow_html=True
             )
+        
+        kv = engine_status.get("kv_cache")
+        if kv:
+            rss = f" · RSS {kv['rss_mb'] / 1024:.1f} GB" if kv.get("rss_mb") else ""
+            st.caption(f"🧠 KV cache {kv['used_mb']:.0f}/{kv['capacity_mb']:.0f} MB ({kv['storage']}){rss}")
     except Exception as e:
         st.error(f"NPU Error: {str(e)}")
         st.stop()
@@ -260,12 +304,15 @@ with st.sidebar:
     st.markdown("**NPU Analysis**")
     analysis_interval = st.slider("Analysis Interval (sec)", 10, 120, 30)
     lookback_minutes = st.slider("Lookback Window (min)", 5, 60, 15)
+    incremental_analysis = st.toggle("Incremental Analysis", value=True, help="Reuse the previous analysis context and only send alerts that changed")
+    per_zone_analysis = st.toggle("Per-Zone Analysis", value=False, help="Analyze each zone separately and merge into a campus-level assessment")
     
     st.divider()
     
     st.markdown("**Display Settings**")
     limit = st.number_input("Max Alerts", min_value=5, max_value=200, value=30, step=5)
     refresh_s = st.number_input("Refresh Rate (sec)", min_value=1, max_value=30, value=2, step=1)
+    burst_gap_s = st.slider("Merge Bursts Within (sec)", 0, 60, 10, help="Group repeated alerts from the same device and event type; 0 disables")
     
     st.divider()
     
@@ -295,7 +342,7 @@ def fetch_alerts():
     r.raise_for_status()
     return r.json()["alerts"]
 
-def analyze_alerts_with_npu(alerts: List[Dict]) -> Dict:
+def analyze_alerts_with_npu(alerts: List[Dict], anomalies: List[Dict]) -> Dict:
     """Analyze alerts using NPU LLM"""
     if not alerts:
         return {
@@ -318,33 +365,43 @@ def analyze_alerts_with_npu(alerts: List[Dict]) -> Dict:
             "npu_processed": True
         }
     
-    alert_summary = []
-    for a in recent_alerts:
-        ts = datetime.fromtimestamp(a["ts"] / 1000.0).strftime("%H:%M:%S")
-        verdict = a.get("operatorVerdict", "UNKNOWN")
-        event = a["eventType"]
-        conf = a.get("modelConfidence", 0)
-        device = a.get("deviceId", "unknown")
-        
-        alert_summary.append(
-            f"- {ts} | {event} | Verdict: {verdict} | "
-            f"Confidence: {conf:.2f} | Device: {device}"
-        )
-    
-    alert_text = "\n".join(alert_summary)
-    
-    yes_count = sum(1 for a in recent_alerts if a.get("operatorVerdict") == "YES")
-    maybe_count = sum(1 for a in recent_alerts if a.get("operatorVerdict") == "MAYBE")
-    
     from npu_llm_engine import get_npu_engine
     npu_engine = get_npu_engine()
     
+    # Leave headroom so an analysis always finishes before the next one is due
+    time_budget_s = analysis_interval * 0.8
+    
+    if per_zone_analysis:
+        return analyze_alerts_sharded(npu_engine, recent_alerts, lookback_minutes, zone_map=DEVICE_ZONES,
+                                      anomalies=anomalies, time_budget_s=time_budget_s)
+    
+    yes_count, maybe_count = count_verdicts(recent_alerts)
+    total = count_alerts(recent_alerts)
+    anomaly_text = "\n".join(format_anomaly_lines(anomalies))
+    
+    if incremental_analysis:
+        alert_lines = {a.get("id", str(i)): format_alert_line(a) for i, a in enumerate(recent_alerts)}
+        return npu_engine.analyze_alerts_incremental(
+            alert_lines,
+            yes_count,
+            maybe_count,
+            total,
+            lookback_minutes,
+            anomaly_text=anomaly_text,
+            time_budget_s=time_budget_s,
+            session_id=st.session_state.session_id
+        )
+    
+    alert_text = "\n".join(format_alert_line(a) for a in recent_alerts)
+    
     analysis = npu_engine.analyze_alerts(
         alert_text, 
         yes_count, 
         maybe_count, 
-        len(recent_alerts),
-        lookback_minutes
+        total,
+        lookback_minutes,
+        anomaly_text=anomaly_text,
+        time_budget_s=time_budget_s
     )
     
     return analysis
@@ -357,6 +414,7 @@ def create_threat_timeline(alerts: List[Dict]):
     times = [datetime.fromtimestamp(a["ts"] / 1000.0) for a in alerts]
     verdicts = [a.get("operatorVerdict", "UNKNOWN") for a in alerts]
     confidences = [a.get("modelConfidence", 0) for a in alerts]
+    sizes = [10 + 2 * min(a.get("count", 1) - 1, 10) for a in alerts]
     
     color_map = {
         "YES": COLORS['danger'],
@@ -374,7 +432,7 @@ def create_threat_timeline(alerts: List[Dict]):
         y=confidences,
         mode='markers+lines',
         marker=dict(
-            size=10,
+            size=sizes,
             color=colors,
             line=dict(width=2, color='white')
         ),
@@ -402,18 +460,20 @@ def create_verdict_distribution(alerts: List[Dict]):
     if not alerts:
         return None
     
-    verdicts = [a.get("operatorVerdict", "UNKNOWN") for a in alerts]
-    verdict_counts = Counter(verdicts)
+    # Count every member of a burst under its own verdict
+    verdict_totals = Counter()
+    for a in alerts:
+        verdict_totals.update(verdict_counts(a))
     
     fig = go.Figure(data=[go.Pie(
-        labels=list(verdict_counts.keys()),
-        values=list(verdict_counts.values()),
+        labels=list(verdict_totals.keys()),
+        values=list(verdict_totals.values()),
         marker=dict(colors=[
             COLORS['danger'] if v == "YES" else
             COLORS['warning'] if v == "MAYBE" else
             COLORS['success'] if v == "NO" else
             COLORS['info']
-            for v in verdict_counts.keys()
+            for v in verdict_totals.keys()
         ]),
         hole=0.4
     )])
@@ -435,8 +495,9 @@ def create_device_activity(alerts: List[Dict]):
     if not alerts:
         return None
     
-    devices = [a.get("deviceId", "unknown") for a in alerts]
-    device_counts = Counter(devices)
+    device_counts = Counter()
+    for a in alerts:
+        device_counts[a.get("deviceId", "unknown")] += a.get("count", 1)
     
     fig = go.Figure(data=[go.Bar(
         x=list(device_counts.keys()),
@@ -467,11 +528,19 @@ if 'cached_analysis' not in st.session_state:
     st.session_state.cached_analysis = None
 if 'alert_history' not in st.session_state:
     st.session_state.alert_history = []
+if 'anomaly_stats' not in st.session_state:
+    st.session_state.anomaly_stats = StreamingAnomalyStats()
+if 'session_id' not in st.session_state:
+    # Keeps this browser session's incremental analysis apart from others sharing the engine
+    st.session_state.session_id = uuid.uuid4().hex
 
 # Fetch and process alerts
 try:
     alerts = fetch_alerts()
     
+    # Only alerts not seen on a previous rerun touch the statistics
+    st.session_state.anomaly_stats.update_many(alerts)
+    
     # Apply filters
     if filter_verdict:
         alerts = [a for a in alerts if a.get("operatorVerdict", "UNKNOWN") in filter_verdict]
@@ -479,16 +548,19 @@ try:
     if filter_device:
         alerts = [a for a in alerts if filter_device.lower() in a.get("deviceId", "").lower()]
     
+    # Everything below works on burst clusters rather than individual frames
+    alerts = cluster_alerts(alerts, burst_gap_s)
+    
 except Exception as e:
     st.error(f"❌ Failed to fetch alerts: {e}")
     st.stop()
 
 # Calculate metrics
-total_alerts = len(alerts)
-threat_alerts = sum(1 for a in alerts if a.get("operatorVerdict") == "YES")
-maybe_alerts = sum(1 for a in alerts if a.get("operatorVerdict") == "MAYBE")
-avg_confidence = sum(a.get("modelConfidence", 0) for a in alerts) / max(len(alerts), 1)
+total_alerts = count_alerts(alerts)
+threat_alerts, maybe_alerts = count_verdicts(alerts)
+avg_confidence = sum(a["meanConfidence"] * a["count"] for a in alerts) / max(total_alerts, 1)
 unique_devices = len(set(a.get("deviceId", "unknown") for a in alerts))
+anomalies = st.session_state.anomaly_stats.top_anomalies(time.time())
 
 # Main Layout: Top row - Metrics (left) + NPU Analysis (right)
 top_row = st.columns([3, 2])
@@ -528,7 +600,7 @@ with top_row[0]:
             f'</div>',
             unsafe_allow_html=True
         )
-    # Second row: Avg Confidence, Active Devices
+    # Second row: Avg Confidence, Active Devices, Spiking
     metric_row2 = st.columns([1, 1, 1])
     
     with metric_row2[0]:
@@ -551,32 +623,57 @@ with top_row[0]:
             unsafe_allow_html=True
         )
     
+    with metric_row2[2]:
+        top_spike = f'📈 {html.escape(anomalies[0]["deviceId"])}' if anomalies else "— Baseline"
+        st.markdown(
+            f'<div class="metric-card" style="border-left-color: {COLORS["secondary"]}">'
+            f'<p class="metric-value">{len(anomalies)}</p>'
+            f'<p class="metric-label">Spiking Now</p>'
+            f'<p class="metric-delta" style="color: {COLORS["secondary"]};">{top_spike}</p>'
+            f'</div>',
+            unsafe_allow_html=True
+        )
+    
     st.markdown("<br>", unsafe_allow_html=True)
     
-    # Alert cards below metrics
+    # Alert list below metrics: one HTML block per page, details rendered only for the selected alert
     if not alerts:
         st.info("🟢 No alerts detected. System monitoring normally.")
     else:
-        st.markdown(f'<p style="color: white; font-weight: 600; margin-bottom: 16px;">📋 Recent Alerts ({min(len(alerts), 15)})</p>', unsafe_allow_html=True)
+        st.markdown(f'<p style="color: white; font-weight: 600; margin-bottom: 16px;">📋 Recent Alerts ({len(alerts)})</p>', unsafe_allow_html=True)
+        
+        page_cols = st.columns([1, 1])
+        with page_cols[1]:
+            page_size = st.selectbox("Per page", [10, 25, 50], key="alert_page_size")
+        n_pages = paginate(alerts, 1, page_size)[1]
+        with page_cols[0]:
+            page = st.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, value=1, step=1, key="alert_page")
+        
+        page_alerts, _ = paginate(alerts, page, page_size)
+        st.markdown(page_html(page_alerts), unsafe_allow_html=True)
         
-        for idx, a in enumerate(alerts[:15]):
-            ts = datetime.fromtimestamp(a["ts"] / 1000.0).strftime("%Y-%m-%d %H:%M:%S")
+        # Lazy detail: only the chosen alert pulls its frame and widgets
+        page_by_id = {a.get("id", str(i)): a for i, a in enumerate(page_alerts)}
+        first = page_alerts[0]
+        default_detail = 1 if page == 1 and first.get("operatorVerdict") in ["YES", "MAYBE"] else 0
+        detail_id = st.selectbox(
+            "🔍 Alert details",
+            [None] + list(page_by_id),
+            index=default_detail,
+            format_func=lambda k: "—" if k is None else alert_label(page_by_id[k]),
+            key=f"alert_detail_{page}"
+        )
+        
+        if detail_id is not None:
+            a = page_by_id[detail_id]
+            ts = format_ts(a["ts"])
             verdict = a.get("operatorVerdict", "UNKNOWN")
             conf = a.get("modelConfidence", 0)
             device = a.get("deviceId", "unknown")
             event_type = a["eventType"]
+            badge, verdict_color, _ = verdict_style(verdict)
             
-            if verdict == "YES":
-                badge = "🚨"
-                verdict_color = COLORS['danger']
-            elif verdict == "MAYBE":
-                badge = "⚠️"
-                verdict_color = COLORS['warning']
-            else:
-                badge = "✅"
-                verdict_color = COLORS['success']
-            
-            with st.expander(f"{badge} {event_type} - {verdict} - {ts}", expanded=(idx < 2 and verdict in ["YES", "MAYBE"])):
+            with st.expander(f"{badge} {event_type} - {verdict} - {ts}", expanded=True):
                 info_cols = st.columns([2, 1, 1])
                 with info_cols[0]:
                     st.markdown(f"**Event Type:** {event_type}")
@@ -587,12 +684,13 @@ with top_row[0]:
                 with info_cols[2]:
                     st.metric("Confidence", f"{conf:.2f}")
                 
-                st.markdown(
-                    f'<div class="confidence-bar" style="margin: 12px 0;">'
-                    f'<div class="confidence-fill" style="width: {conf*100}%; background: {verdict_color};"></div>'
-                    f'</div>',
-                    unsafe_allow_html=True
-                )
+                if a["count"] > 1:
+                    span_s = (a["lastTs"] - a["firstTs"]) / 1000.0
+                    breakdown = ", ".join(f"{n} {v}" for v, n in verdict_counts(a).items())
+                    st.caption(
+                        f"🔁 {a['count']} alerts over {span_s:.0f}s ({breakdown}) · "
+                        f"max {a['maxConfidence']:.2f} · mean {a['meanConfidence']:.2f} · showing best frame"
+                    )
                 
                 notes = a.get("notes")
                 if notes:
@@ -615,7 +713,7 @@ with top_row[1]:
         st.session_state.last_analysis_time = current_time
         with st.spinner("🧠 Analyzing with Snapdragon X Elite NPU..."):
             try:
-                analysis = analyze_alerts_with_npu(alerts)
+                analysis = analyze_alerts_with_npu(alerts, anomalies)
                 st.session_state.cached_analysis = analysis
             except Exception as e:
                 st.error(f"❌ NPU Analysis Failed: {str(e)}")
@@ -649,9 +747,22 @@ with top_row[1]:
         
         st.markdown("<br>", unsafe_allow_html=True)
         
+        zones = analysis.get("zones")
+        if zones:
+            st.markdown("### 🗺️ Zone Levels")
+            for zone, info in zones.items():
+                st.markdown(
+                    f'<div class="recommendation-item" style="color: {COLORS["dark"]}">'
+                    f'<span class="threat-badge threat-{html.escape(info["threat_level"].lower())}" style="padding: 4px 10px; margin-right: 8px;">{html.escape(info["threat_level"])}</span>'
+                    f'<strong>{html.escape(zone)}</strong> · {info["alerts"]} alerts{" · NPU" if info["npu_processed"] else ""}'
+                    f'</div>',
+                    unsafe_allow_html=True
+                )
+            st.markdown("<br>", unsafe_allow_html=True)
+        
         st.markdown("### 📋 Recommended Actions")
         for i, rec in enumerate(analysis["recommendations"], 1):
-            st.markdown(f'<div class="recommendation-item" style="color: {COLORS["dark"]}"><strong>{i}.</strong> {rec}</div>', unsafe_allow_html=True)
+            st.markdown(f'<div class="recommendation-item" style="color: {COLORS["dark"]}"><strong>{i}.</strong> {html.escape(rec)}</div>', unsafe_allow_html=True)
         
         if analysis.get("alert_security"):
             st.markdown(
@@ -1,46 +1,344 @@
 """
-Download Phi-3-mini ONNX model optimized for Snapdragon X Elite NPU
+Provision Phi-3-mini ONNX model optimized for Snapdragon X Elite NPU
+
+Downloads the model files in parallel (interrupted downloads resume),
+verifies every file against a manifest, pre-optimizes the graph for this
+machine's execution provider and writes a bundle the engine loads without
+re-optimizing. The bundle's file hashes are recorded in bundle.json and in
+the manifest, so the manifest pins the optimized graph too.
+
+Works fully offline from a pre-staged archive. An archive can't vouch for
+itself, so offline installs verify it against a pinned manifest (the
+models/phi3/manifest.json of the machine that packed it), passed
+separately. Staged bundles that manifest doesn't pin are removed and
+rebuilt locally.
+
+    python download_llm.py                            # download, verify, optimize
+    python download_llm.py --pack phi3-bundle.tar     # also stage an archive for other machines
+    python download_llm.py --from-archive phi3-bundle.tar --manifest manifest.json   # offline install
 """
 
-from huggingface_hub import snapshot_download
-from pathlib import Path
+import argparse
+import hashlib
+import json
 import shutil
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Optional
+
+MODEL_ID = "microsoft/Phi-3-mini-4k-instruct-onnx"
+MODEL_SUBDIR = "cpu_and_mobile/cpu-int4-rtn-block-32-acc-level-4"
+
+MODELS_DIR = Path("models")
+MODEL_DIR = MODELS_DIR / "phi3"
+MODEL_PATH = MODEL_DIR / MODEL_SUBDIR
+BUNDLE_DIR = MODELS_DIR / "bundle"
+MANIFEST_FILE = MODEL_DIR / "manifest.json"
+
+# Copied next to the optimized graph so the bundle is self-contained
+TOKENIZER_FILES = [
+    "tokenizer.json",
+    "tokenizer.model",
+    "tokenizer_config.json",
+    "special_tokens_map.json",
+    "added_tokens.json",
+]
+
+HASH_CHUNK = 8 * 1024 * 1024
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def git_blob_sha1(path: Path) -> str:
+    """Hash the way git does, for small files the Hub stores without LFS"""
+    digest = hashlib.sha1(f"blob {path.stat().st_size}\0".encode())
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(model_id: str = MODEL_ID) -> Dict:
+    """Fetch file sizes and hashes for the model folder from the Hub"""
+    from huggingface_hub import HfApi
+
+    info = HfApi().model_info(model_id, files_metadata=True)
+    files = {}
+    for sibling in info.siblings:
+        if not sibling.rfilename.startswith(MODEL_SUBDIR + "/"):
+            continue
+        entry = {"size": sibling.size}
+        if sibling.lfs:
+            entry["sha256"] = sibling.lfs.sha256
+        else:
+            entry["git_sha1"] = sibling.blob_id
+        files[sibling.rfilename] = entry
+
+    return {"model_id": model_id, "revision": info.sha, "files": files}
+
+
+def verify_file(path: Path, entry: Dict) -> bool:
+    if not path.exists() or (entry.get("size") is not None and path.stat().st_size != entry["size"]):
+        return False
+    if "sha256" in entry:
+        return file_sha256(path) == entry["sha256"]
+    if "git_sha1" in entry:
+        return git_blob_sha1(path) == entry["git_sha1"]
+    return True
+
+
+def hash_files(root: Path, names: List[str]) -> Dict[str, Dict]:
+    """Size and SHA-256 of each file under root, in manifest entry form"""
+    return {name: {"size": (root / name).stat().st_size, "sha256": file_sha256(root / name)} for name in names}
+
+
+def verify_bundle(bundle: Path, files: Optional[Dict[str, Dict]] = None) -> List[str]:
+    """
+    Bundle files that are missing or don't match `files` (default: the
+    hashes recorded in the bundle's own bundle.json)
+    """
+    if files is None:
+        try:
+            files = json.loads((bundle / "bundle.json").read_text())["files"]
+        except (OSError, ValueError, KeyError):
+            return ["bundle.json"]
+    if "model.optimized.onnx" not in files:
+        return ["model.optimized.onnx"]
+    return [name for name, entry in files.items() if not verify_file(bundle / name, entry)]
+
+
+def verify_all(manifest: Dict, root: Path, workers: int) -> List[str]:
+    """Return the manifest paths that are missing or fail verification"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda item: (item[0], verify_file(root / item[0], item[1])), manifest["files"].items())
+        return [name for name, ok in results if not ok]
+
+
+def download_files(manifest: Dict, names: List[str], workers: int):
+    """Download files in parallel; huggingface_hub resumes partial files"""
+    from huggingface_hub import hf_hub_download
+
+    total_mb = sum(manifest["files"][n].get("size") or 0 for n in names) / (1024 * 1024)
+    print(f"\n📥 Downloading {len(names)} files ({total_mb:.0f} MB) with {workers} workers...")
+
+    def fetch(name: str) -> str:
+        # huggingface_hub keeps interrupted downloads here and continues them
+        partial_dir = (MODEL_DIR / ".cache" / "huggingface" / "download" / name).parent
+        if any(partial_dir.glob(Path(name).name + ".*.incomplete")):
+            print(f"  ↻ {name} (resuming)")
+        hf_hub_download(
+            repo_id=manifest["model_id"],
+            filename=name,
+            revision=manifest.get("revision"),
+            local_dir=str(MODEL_DIR),
+        )
+        return name
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch, name) for name in names]
+        for future in as_completed(futures):
+            name = future.result()
+            size_mb = (manifest["files"][name].get("size") or 0) / (1024 * 1024)
+            print(f"  ✓ {name} ({size_mb:.1f} MB)")
+
+
+def detect_provider() -> str:
+    import onnxruntime as ort
+
+    available = ort.get_available_providers()
+    return "DmlExecutionProvider" if "DmlExecutionProvider" in available else "CPUExecutionProvider"
+
+
+def optimize_for_provider(model_path: Path, provider: str) -> Path:
+    """
+    Run ONNX Runtime's graph optimizations once, offline, and save the
+    result with its weights in a single external-data file that ORT
+    memory-maps on load.
+    """
+    import onnxruntime as ort
+
+    onnx_files = sorted(model_path.glob("*.onnx"))
+    if not onnx_files:
+        raise FileNotFoundError(f"No ONNX model found in {model_path}")
 
-def download_phi3_onnx():
+    bundle = BUNDLE_DIR / provider
+    bundle.mkdir(parents=True, exist_ok=True)
+    optimized = bundle / "model.optimized.onnx"
+
+    options = ort.SessionOptions()
+    # Layout-specific (extended) fusions are CPU EP kernels; DirectML only takes the basic ones
+    options.graph_optimization_level = (
+        ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED if provider == "CPUExecutionProvider"
+        else ort.GraphOptimizationLevel.ORT_ENABLE_BASIC
+    )
+    options.optimized_model_filepath = str(optimized)
+    options.add_session_config_entry("session.optimized_model_external_initializers_file_name", optimized.name + ".data")
+    options.add_session_config_entry("session.optimized_model_external_initializers_min_size_in_bytes", "1024")
+
+    print(f"\n⚙️  Optimizing {onnx_files[0].name} for {provider}...")
+    start = time.time()
+    ort.InferenceSession(str(onnx_files[0]), sess_options=options, providers=[provider])
+    print(f"  ✓ Optimized graph written in {time.time() - start:.1f}s")
+
+    files = [optimized.name, optimized.name + ".data"]
+    for name in TOKENIZER_FILES:
+        src = model_path / name
+        if src.exists():
+            (bundle / name).write_bytes(src.read_bytes())
+            files.append(name)
+
+    (bundle / "bundle.json").write_text(json.dumps({
+        "provider": provider,
+        "onnxruntime": ort.__version__,
+        "source": onnx_files[0].name,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "files": hash_files(bundle, [name for name in files if (bundle / name).exists()]),
+    }, indent=2))
+
+    return bundle
+
+
+def bundle_is_current(bundle: Path) -> bool:
+    """A staged bundle is only reusable with the same onnxruntime build"""
+    import onnxruntime as ort
+
+    try:
+        info = json.loads((bundle / "bundle.json").read_text())
+    except (OSError, ValueError):
+        return False
+    return info.get("onnxruntime") == ort.__version__ and (bundle / "model.optimized.onnx").exists()
+
+
+def pin_bundle(manifest: Dict, bundle: Path):
+    """Record a bundle's file hashes in the manifest, so archives packed from it carry them"""
+    info = json.loads((bundle / "bundle.json").read_text())
+    manifest.setdefault("bundles", {})[bundle.name] = {"onnxruntime": info["onnxruntime"], "files": info["files"]}
+
+
+def verify_staged_bundles(manifest: Dict):
+    """Keep only the extracted bundles the pinned manifest vouches for"""
+    if not BUNDLE_DIR.exists():
+        return
+    pinned = manifest.get("bundles", {})
+    for bundle in sorted(p for p in BUNDLE_DIR.iterdir() if p.is_dir()):
+        entry = pinned.get(bundle.name)
+        bad = verify_bundle(bundle, entry["files"]) if entry else ["not in the pinned manifest"]
+        if bad:
+            print(f"  ✗ Discarding staged {bundle.name} bundle ({', '.join(bad)})")
+            shutil.rmtree(bundle)
+        else:
+            print(f"  ✓ {bundle.name} bundle verified")
+
+
+def extract_archive(archive: Path):
+    print(f"\n📦 Extracting {archive} (offline)...")
+    with tarfile.open(archive) as tar:
+        tar.extractall(MODELS_DIR, filter="data")
+
+
+def pack_archive(archive: Path):
+    """Stage model files, manifest and bundles for offline installs elsewhere"""
+    print(f"\n📦 Packing {archive}...")
+    mode = "w:gz" if archive.suffix == ".gz" else "w"
+    with tarfile.open(archive, mode) as tar:
+        tar.add(MANIFEST_FILE, arcname=str(MANIFEST_FILE.relative_to(MODELS_DIR)))
+        tar.add(MODEL_PATH, arcname=str(MODEL_PATH.relative_to(MODELS_DIR)))
+        if BUNDLE_DIR.exists():
+            tar.add(BUNDLE_DIR, arcname=str(BUNDLE_DIR.relative_to(MODELS_DIR)))
+    print(f"  ✓ {archive} ({archive.stat().st_size / (1024 * 1024):.0f} MB)")
+
+
+def download_phi3_onnx(workers: int = 8, archive: Optional[Path] = None, manifest_path: Optional[Path] = None,
+                       optimize: bool = True, pack: Optional[Path] = None) -> Path:
     print("="*60)
-    print("Downloading Phi-3-mini ONNX for Snapdragon X Elite NPU")
+    print("Provisioning Phi-3-mini ONNX for Snapdragon X Elite NPU")
     print("="*60)
-    
-    model_id = "microsoft/Phi-3-mini-4k-instruct-onnx"
-    
-    # Create models directory
-    models_dir = Path("models")
-    models_dir.mkdir(exist_ok=True)
-    
-    print("\n📥 Downloading model (this may take 5-10 minutes)...")
-    print(f"Model: {model_id}")
-    
-    # Download from HuggingFace
-    cache_dir = snapshot_download(
-        repo_id=model_id,
-        allow_patterns=["cpu_and_mobile/cpu-int4-rtn-block-32-acc-level-4/*"],
-        cache_dir=str(models_dir / "cache"),
-        local_dir=str(models_dir / "phi3"),
-        local_dir_use_symlinks=False
-    )
-    
-    print(f"\n✅ Model downloaded to: {models_dir / 'phi3'}")
-    print(f"📊 Model size: ~2GB (quantized INT4)")
-    
-    # List downloaded files
-    model_path = models_dir / "phi3" / "cpu_and_mobile" / "cpu-int4-rtn-block-32-acc-level-4"
+
+    if archive and not manifest_path:
+        # The manifest inside the archive would only be checking itself
+        raise ValueError(f"Offline installs need --manifest: the pinned {MANIFEST_FILE.name} "
+                         f"from the machine that packed {archive}")
+
+    MODEL_DIR.mkdir(parents=True, exist_ok=True)
+    start = time.time()
+
+    # Read before extracting, so the archive can't replace the pinned manifest
+    manifest = json.loads(manifest_path.read_text()) if manifest_path else None
+
+    if archive:
+        extract_archive(archive)
+
+    # Manifest precedence: explicit file, then a staged one, then the Hub
+    if manifest is not None:
+        pass
+    elif MANIFEST_FILE.exists():
+        manifest = json.loads(MANIFEST_FILE.read_text())
+    else:
+        print(f"\nModel: {MODEL_ID}")
+        manifest = build_manifest()
+    MANIFEST_FILE.write_text(json.dumps(manifest, indent=2))
+
+    print(f"\n🔍 Verifying {len(manifest['files'])} files against manifest...")
+    missing = verify_all(manifest, MODEL_DIR, workers)
+
+    if missing:
+        if archive:
+            raise RuntimeError(f"Archive failed verification: {', '.join(missing)}")
+        download_files(manifest, missing, workers)
+        missing = verify_all(manifest, MODEL_DIR, workers)
+        if missing:
+            raise RuntimeError(f"Checksum mismatch after download: {', '.join(missing)}")
+    print("  ✓ All files verified")
+
+    if archive:
+        print("\n🔍 Verifying staged bundles against manifest...")
+        verify_staged_bundles(manifest)
+
+    if optimize:
+        provider = detect_provider()
+        if archive and bundle_is_current(BUNDLE_DIR / provider):
+            print(f"\n⚙️  Using pre-built {provider} bundle from archive")
+        else:
+            optimize_for_provider(MODEL_PATH, provider)
+            pin_bundle(manifest, BUNDLE_DIR / provider)
+            MANIFEST_FILE.write_text(json.dumps(manifest, indent=2))
+
+    if pack:
+        pack_archive(pack)
+
+    print(f"\n✅ Model provisioned in {time.time() - start:.0f}s: {MODEL_PATH}")
+
+    # List provisioned files
     print(f"\n📁 Model files:")
-    for f in model_path.glob("*"):
+    for f in sorted(MODEL_PATH.glob("*")):
         size_mb = f.stat().st_size / (1024 * 1024)
         print(f"  - {f.name} ({size_mb:.1f} MB)")
-    
-    return model_path
+
+    return MODEL_PATH
 
 if __name__ == "__main__":
-    model_path = download_phi3_onnx()
-    print(f"\n🚀 Ready to use! Model path: {model_path}")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Download, verify and optimize the CampusGuard LLM")
+    parser.add_argument("--workers", type=int, default=8, help="parallel downloads/hash checks")
+    parser.add_argument("--from-archive", type=Path, help="install offline from a tar archive made with --pack")
+    parser.add_argument("--manifest", type=Path,
+                        help="pinned manifest.json to verify against (required with --from-archive)")
+    parser.add_argument("--no-optimize", action="store_true", help="skip building the optimized bundle")
+    parser.add_argument("--pack", type=Path, help="write a tar archive for offline installs on other machines")
+    args = parser.parse_args()
+
+    model_path = download_phi3_onnx(
+        workers=args.workers,
+        archive=args.from_archive,
+        manifest_path=args.manifest,
+        optimize=not args.no_optimize,
+        pack=args.pack,
+    )
+    print(f"\n🚀 Ready to use! Model path: {model_path}")
@@ -0,0 +1,448 @@
+"""
+Standalone inference worker that owns the NPU LLM and serves every dashboard process
+
+Run once per machine:
+    python inference_worker.py --address 127.0.0.1:8790
+
+Then start each Streamlit replica with CAMPUSGUARD_WORKER=127.0.0.1:8790 so that
+get_npu_engine() returns an InferenceClient instead of loading its own model.
+
+Connections are authenticated with a shared secret from CAMPUSGUARD_WORKER_KEY
+or models/worker.key (create it once with --init-key). Without one the
+worker refuses to start and clients refuse to connect: the connection
+unpickles what it receives, so the key is what keeps other users out.
+
+Clients turn a call's time_budget_s into an absolute deadline. Time spent
+queued behind other dashboards' calls comes out of the budget, a call whose
+deadline passes before the engine is free is refused (the client falls
+back to rule-based analysis), and every hop waits for a reply only until
+the deadline plus a short grace period.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import secrets
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from npu_llm_engine import fallback_analysis
+
+DEFAULT_ADDRESS = "127.0.0.1:8790"
+KEY_FILE = Path("models") / "worker.key"
+
+# Engine methods that clients are allowed to call
+SERVED_METHODS = {"analyze_alerts", "analyze_alerts_incremental", "generate_text", "get_status"}
+
+# Arguments that don't change the answer, so identical requests from different sessions share one call
+DEDUP_IGNORED_KWARGS = {"session_id"}
+
+# Slack past a call's deadline for the reply to arrive (parsing, IPC)
+REPLY_GRACE_S = 2.0
+# Longest wait for a call without a time budget before the engine is considered hung
+DEFAULT_CALL_TIMEOUT_S = 300.0
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """Turn "host:port" into a (host, port) tuple"""
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def load_authkey() -> bytes:
+    """Shared secret from CAMPUSGUARD_WORKER_KEY, else the per-install key file"""
+    key = os.environ.get("CAMPUSGUARD_WORKER_KEY", "").strip()
+    if not key:
+        try:
+            key = KEY_FILE.read_text().strip()
+        except OSError:
+            key = ""
+    if not key:
+        raise RuntimeError(
+            f"No inference worker key: set CAMPUSGUARD_WORKER_KEY or run "
+            f"'python inference_worker.py --init-key' to create {KEY_FILE}"
+        )
+    return key.encode()
+
+
+def init_authkey() -> Path:
+    """Create a random per-install key readable only by this user"""
+    if KEY_FILE.exists():
+        return KEY_FILE
+    KEY_FILE.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(secrets.token_hex(32))
+    return KEY_FILE
+
+
+def _engine_main(conn):
+    """
+    Child process entry point: load the engine once and execute jobs forever
+    """
+    from npu_llm_engine import NPU_LLM_Engine
+
+    try:
+        engine = NPU_LLM_Engine()
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+
+    conn.send(("ready", engine.get_status()))
+
+    while True:
+        try:
+            method, args, kwargs = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            conn.send(("ok", getattr(engine, method)(*args, **kwargs)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class EngineSupervisor:
+    """
+    Runs NPU_LLM_Engine in a child process and restarts it if it dies, so a
+    crash inside ONNX Runtime never takes the worker (or the UI) down with it
+    """
+
+    def __init__(self, startup_timeout: float = 600.0, call_timeout: float = DEFAULT_CALL_TIMEOUT_S):
+        self.startup_timeout = startup_timeout
+        self.call_timeout = call_timeout
+        self.restarts = 0
+        self.engine_status: Dict = {}
+        self._lock = threading.Lock()
+        self._process = None
+        self._conn = None
+        self._start()
+
+    def _start(self):
+        ctx = mp.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_engine_main, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+
+        if not self._conn.poll(self.startup_timeout):
+            self._process.kill()
+            raise RuntimeError("Engine process did not become ready in time")
+
+        status, payload = self._conn.recv()
+        if status != "ready":
+            raise RuntimeError(f"Engine process failed to start: {payload}")
+
+        self.engine_status = payload
+        print(f"✅ Engine process ready (pid {self._process.pid}, {payload.get('provider')})")
+
+    def _restart(self):
+        self.restarts += 1
+        print(f"♻️  Restarting engine process (restart #{self.restarts})...")
+        if self._process is not None and self._process.is_alive():
+            self._process.kill()
+        self._process.join(timeout=5)
+        self._start()
+
+    def _request(self, method: str, args: tuple, kwargs: dict, timeout: float):
+        try:
+            self._conn.send((method, args, kwargs))
+            answered = self._conn.poll(timeout)
+            if answered:
+                return self._conn.recv()
+        except (EOFError, OSError) as e:
+            # The engine died mid-request; bring up a fresh one for the next caller
+            self._restart()
+            raise RuntimeError(f"Engine process crashed during {method}: {e}")
+
+        # A hung engine would block every caller behind it
+        self._restart()
+        raise RuntimeError(f"Engine process did not answer {method} within {timeout:.0f}s; restarted it")
+
+    def call(self, method: str, args: tuple, kwargs: dict, deadline: Optional[float] = None):
+        """
+        Run one engine call. With an absolute `deadline` (time.time()), the
+        time left when the engine becomes free is passed on as time_budget_s,
+        and the call is refused if none is left.
+        """
+        wait_s = deadline - time.time() if deadline is not None else self.call_timeout
+        if not self._lock.acquire(timeout=max(wait_s, 0.0)):
+            raise TimeoutError(f"{method} waited for the engine past its deadline")
+
+        try:
+            if not self._process.is_alive():
+                self._restart()
+
+            timeout = self.call_timeout
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"{method} waited for the engine past its deadline")
+                kwargs = dict(kwargs, time_budget_s=remaining)
+                timeout = remaining + REPLY_GRACE_S
+
+            status, payload = self._request(method, args, kwargs, timeout)
+            if status == "error":
+                raise RuntimeError(payload)
+
+            if method != "get_status":
+                _, self.engine_status = self._request("get_status", (), {}, REPLY_GRACE_S * 5)
+
+            return payload
+        finally:
+            self._lock.release()
+
+
+class _PendingCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[str] = None
+        self.finished_at = 0.0
+
+
+class InferenceWorker:
+    """
+    Serves engine calls over a local socket.
+
+    Identical requests that arrive while one is already running (or within
+    dedup_ttl seconds of it finishing) share a single engine call, so N
+    dashboard replicas polling the same alerts cost one inference, not N.
+    Incremental requests are identical regardless of their session: the
+    result is shared and only the session that ran it advances its
+    conversation. The others keep theirs and send a larger delta next time.
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, dedup_ttl: float = 5.0):
+        self.address = parse_address(address)
+        self.authkey = load_authkey()
+        self.dedup_ttl = dedup_ttl
+        self.supervisor = EngineSupervisor()
+        self.started_at = time.time()
+        self.clients = 0
+        self.requests = 0
+        self.deduplicated = 0
+        self._calls: Dict[str, _PendingCall] = {}
+        self._calls_lock = threading.Lock()
+
+    def _request_key(self, method: str, args: tuple, kwargs: dict) -> str:
+        kwargs = {k: v for k, v in kwargs.items() if k not in DEDUP_IGNORED_KWARGS}
+        payload = json.dumps([method, args, kwargs], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _status(self) -> Dict:
+        status = dict(self.supervisor.engine_status)
+        status["worker"] = {
+            "pid": os.getpid(),
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "clients": self.clients,
+            "requests": self.requests,
+            "deduplicated": self.deduplicated,
+            "engine_restarts": self.supervisor.restarts,
+        }
+        return status
+
+    def dispatch(self, method: str, args: tuple, kwargs: dict):
+        if method not in SERVED_METHODS:
+            raise ValueError(f"Unsupported method: {method}")
+
+        self.requests += 1
+
+        # Status is answered locally so it never queues behind a long analysis
+        if method == "get_status":
+            return self._status()
+
+        # Not part of the request's identity: callers of the same analysis just wait for it
+        deadline = kwargs.pop("deadline", None)
+        key = self._request_key(method, args, kwargs)
+        now = time.time()
+
+        with self._calls_lock:
+            # Drop finished results that have aged out
+            for k in [k for k, c in self._calls.items()
+                      if c.done.is_set() and now - c.finished_at > self.dedup_ttl]:
+                del self._calls[k]
+
+            pending = self._calls.get(key)
+            owner = pending is None
+            if owner:
+                pending = _PendingCall()
+                self._calls[key] = pending
+            else:
+                self.deduplicated += 1
+
+        if owner:
+            try:
+                pending.result = self.supervisor.call(method, args, kwargs, deadline)
+            except Exception as e:
+                pending.error = str(e)
+                with self._calls_lock:
+                    # Never cache failures; the next caller should retry
+                    self._calls.pop(key, None)
+            finally:
+                pending.finished_at = time.time()
+                pending.done.set()
+        else:
+            wait_s = deadline - time.time() + REPLY_GRACE_S if deadline is not None else None
+            if not pending.done.wait(wait_s):
+                raise TimeoutError(f"Shared {method} call did not finish before this request's deadline")
+
+        if pending.error is not None:
+            raise RuntimeError(pending.error)
+        return pending.result
+
+    def _serve_client(self, conn):
+        self.clients += 1
+        try:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+
+                try:
+                    reply = ("ok", self.dispatch(method, tuple(args), dict(kwargs)))
+                except Exception as e:
+                    reply = ("error", str(e))
+
+                try:
+                    conn.send(reply)
+                except OSError:
+                    return
+        finally:
+            self.clients -= 1
+            conn.close()
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"🛰️  Inference worker listening on {self.address[0]}:{self.address[1]}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f"⚠️  Rejected connection: {e}")
+                    continue
+                threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+
+
+class InferenceClient:
+    """
+    Drop-in stand-in for NPU_LLM_Engine that forwards calls to the shared worker.
+
+    Reconnects automatically; if the worker stays unreachable, analyze_alerts
+    degrades to the rule-based fallback instead of raising into the UI.
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, retries: int = 3, retry_delay: float = 0.5,
+                 call_timeout: float = DEFAULT_CALL_TIMEOUT_S):
+        self.address = parse_address(address)
+        self.authkey = load_authkey()
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.call_timeout = call_timeout
+        self.initialized = True
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _disconnect(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+        self._conn = None
+
+    def _call(self, method: str, *args, **kwargs):
+        last_error = None
+
+        # The budget starts now, not when the worker gets round to this call
+        deadline = None
+        time_budget_s = kwargs.pop("time_budget_s", None)
+        if time_budget_s:
+            deadline = time.time() + time_budget_s
+            kwargs["deadline"] = deadline
+
+        with self._lock:
+            for attempt in range(self.retries):
+                try:
+                    if self._conn is None:
+                        self._conn = Client(self.address, authkey=self.authkey)
+                    self._conn.send((method, args, kwargs))
+                    timeout = deadline - time.time() + REPLY_GRACE_S if deadline is not None else self.call_timeout
+                    answered = self._conn.poll(max(timeout, 0.0))
+                    if answered:
+                        status, payload = self._conn.recv()
+                    break
+                except (OSError, EOFError) as e:
+                    last_error = e
+                    self._disconnect()
+                    time.sleep(self.retry_delay * (attempt + 1))
+            else:
+                raise ConnectionError(f"Inference worker unavailable: {last_error}")
+
+            if not answered:
+                # A late reply would be read as the answer to the next call
+                self._disconnect()
+                raise TimeoutError(f"Inference worker did not answer {method} in time")
+
+        if status == "error":
+            raise RuntimeError(payload)
+        return payload
+
+    def generate_text(self, prompt: str, max_tokens: int = 500, time_budget_s: Optional[float] = None,
+                      temperature: float = 0.0, top_k: int = 0, top_p: float = 1.0,
+                      repetition_penalty: float = 1.0, seed: Optional[int] = None) -> str:
+        return self._call("generate_text", prompt, max_tokens=max_tokens, time_budget_s=time_budget_s,
+                          temperature=temperature, top_k=top_k, top_p=top_p,
+                          repetition_penalty=repetition_penalty, seed=seed)
+
+    def analyze_alerts(self, alert_text: str, yes_count: int, maybe_count: int, total: int, lookback_minutes: int,
+                       anomaly_text: str = "", time_budget_s: Optional[float] = None) -> Dict:
+        try:
+            return self._call("analyze_alerts", alert_text, yes_count, maybe_count, total, lookback_minutes,
+                              anomaly_text=anomaly_text, time_budget_s=time_budget_s)
+        except Exception as e:
+            print(f"❌ Inference worker error: {e}")
+            print("Using fallback analysis...")
+            return fallback_analysis(yes_count, maybe_count, total, anomaly_text)
+
+    def analyze_alerts_incremental(self, alert_lines: Dict[str, str], yes_count: int, maybe_count: int, total: int,
+                                   lookback_minutes: int, anomaly_text: str = "",
+                                   time_budget_s: Optional[float] = None, session_id: str = "default") -> Dict:
+        try:
+            return self._call("analyze_alerts_incremental", alert_lines, yes_count, maybe_count, total,
+                              lookback_minutes, anomaly_text=anomaly_text, time_budget_s=time_budget_s,
+                              session_id=session_id)
+        except Exception as e:
+            print(f"❌ Inference worker error: {e}")
+            print("Using fallback analysis...")
+            return fallback_analysis(yes_count, maybe_count, total, anomaly_text)
+
+    def get_status(self) -> Dict:
+        try:
+            return self._call("get_status")
+        except Exception as e:
+            return {"provider": "unavailable", "initialized": False, "error": str(e)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CampusGuard shared LLM inference worker")
+    parser.add_argument("--address", default=os.environ.get("CAMPUSGUARD_WORKER", DEFAULT_ADDRESS),
+                        help="host:port to listen on (default: %(default)s)")
+    parser.add_argument("--dedup-ttl", type=float, default=5.0,
+                        help="seconds to reuse a finished result for identical requests")
+    parser.add_argument("--init-key", action="store_true",
+                        help=f"create {KEY_FILE} with a random key (kept if it already exists) and exit")
+    cli_args = parser.parse_args()
+    
+    if cli_args.init_key:
+        print(f"🔑 Worker key: {init_authkey()}")
+        raise SystemExit(0)
+
+    InferenceWorker(cli_args.address, dedup_ttl=cli_args.dedup_ttl).serve_forever()
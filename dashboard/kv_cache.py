@@ -0,0 +1,296 @@
+"""
+Bounded KV-cache memory for NPU_LLM_Engine
+
+Two kinds of memory are managed here:
+
+- Stored states (the incremental-analysis session, shared prompt prefixes)
+  live in one block pool sized to a fixed cap. Entries take fixed-size
+  token blocks, can be stored as fp16 or int8 (per block/head scales), and
+  the least recently used entry is evicted when a new one doesn't fit.
+- Decode workspaces: two flat buffers per layer that ONNX Runtime writes
+  `present` into through IO binding, alternating every step, instead of
+  allocating a new, longer KV array for each generated token.
+
+Both count against the same cap: when workspaces and stored states together
+would exceed it, idle workspaces are dropped first, then stored states are
+evicted. A workspace that can't fit is refused; callers size their decodes
+with max_decode_tokens() so that doesn't happen. Freed blocks and idle workspaces are reused before fresh memory is
+touched, so resident memory stays near peak occupancy rather than growing
+with churn.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+STORAGE_DTYPES = {"fp32": np.float32, "fp16": np.float16, "int8": np.int8}
+
+
+def process_rss_bytes() -> Optional[int]:
+    """Resident memory of this process, if the platform lets us see it"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class KVWorkspace:
+    """
+    Ping-pong decode buffers. views(side, length) gives (1, heads, length,
+    head_dim) arrays at the start of a flat buffer, so every length is
+    contiguous without copying. One step reads its past from one side while
+    ORT writes the present into the other.
+    """
+
+    def __init__(self, names: List[str], kv_heads: int, head_dim: int, dtype, tokens: int):
+        self.names = names
+        self.kv_heads = kv_heads
+        self.head_dim = head_dim
+        self.tokens = tokens
+        size = kv_heads * tokens * head_dim
+        self._buffers = [{name: np.empty(size, dtype=dtype) for name in names} for _ in range(2)]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buf.nbytes for side in self._buffers for buf in side.values())
+
+    def views(self, side: int, length: int) -> Dict[str, np.ndarray]:
+        size = self.kv_heads * length * self.head_dim
+        return {
+            name: buf[:size].reshape(1, self.kv_heads, length, self.head_dim)
+            for name, buf in self._buffers[side].items()
+        }
+
+
+class KVCacheManager:
+    def __init__(self, names: List[str], kv_heads: int, head_dim: int, kv_dtype, max_bytes: Optional[int] = None,
+                 storage: str = "auto", block_tokens: int = 64, max_idle_workspaces: int = 2,
+                 context_tokens: int = 2048):
+        self.names = names
+        self.kv_heads = kv_heads
+        self.head_dim = head_dim
+        self.kv_dtype = np.dtype(kv_dtype)
+        self.block_tokens = block_tokens
+        self.max_idle_workspaces = max_idle_workspaces
+
+        if storage == "auto":
+            self.storage_dtype = self.kv_dtype
+        elif storage in STORAGE_DTYPES:
+            self.storage_dtype = np.dtype(STORAGE_DTYPES[storage])
+        else:
+            raise ValueError(f"Unknown KV storage {storage!r}; use auto, {', '.join(STORAGE_DTYPES)}")
+        self.quantized = self.storage_dtype == np.int8
+
+        if max_bytes is None:
+            max_bytes = self.default_max_bytes(context_tokens)
+        self.max_bytes = max_bytes
+
+        # One block holds block_tokens positions of every layer's K and V
+        self.block_bytes = len(names) * kv_heads * block_tokens * head_dim * self.storage_dtype.itemsize
+        if self.quantized:
+            self.block_bytes += len(names) * kv_heads * 4
+        self.num_blocks = max(0, max_bytes // self.block_bytes)
+
+        # np.empty only reserves address space; pages are committed as blocks are first written
+        self._data = np.empty((len(names), self.num_blocks, kv_heads, block_tokens, head_dim), dtype=self.storage_dtype)
+        self._scales = np.empty((len(names), self.num_blocks, kv_heads), dtype=np.float32) if self.quantized else None
+
+        # LIFO so recently freed (already resident) blocks are handed out first
+        self._free: List[int] = list(range(self.num_blocks - 1, -1, -1))
+        self._entries: "OrderedDict[str, Tuple[np.ndarray, int]]" = OrderedDict()
+        self._workspaces: List[KVWorkspace] = []
+        self._workspaces_in_use = 0
+        self._workspace_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def default_max_bytes(self, context_tokens: int) -> int:
+        """
+        Room for one decode workspace and two stored states, all of
+        context_tokens (plus drafting headroom)
+        """
+        tokens = -(-context_tokens // self.block_tokens) * self.block_tokens + 2 * self.block_tokens
+        per_token = len(self.names) * self.kv_heads * self.head_dim
+        workspace = 2 * tokens * per_token * self.kv_dtype.itemsize
+        stored = 2 * tokens * per_token * self.storage_dtype.itemsize
+        if self.quantized:
+            stored += 2 * (tokens // self.block_tokens) * len(self.names) * self.kv_heads * 4
+        return workspace + stored
+
+    def _workspace_size(self, tokens: int) -> int:
+        """Bytes of a workspace for `tokens` positions (rounded up to whole blocks)"""
+        tokens = -(-tokens // self.block_tokens) * self.block_tokens
+        return 2 * tokens * len(self.names) * self.kv_heads * self.head_dim * self.kv_dtype.itemsize
+
+    def max_decode_tokens(self) -> int:
+        """
+        Longest decode (past + prompt + new tokens) whose workspace fits
+        under the cap together with the state it leaves behind
+        """
+        per_block = self._workspace_size(self.block_tokens) + self.block_bytes
+        return self.max_bytes // per_block * self.block_tokens
+
+    def _used_bytes(self) -> int:
+        return (self.num_blocks - len(self._free)) * self.block_bytes + self._workspace_bytes
+
+    def _make_room(self, extra_bytes: int = 0) -> bool:
+        """
+        Drop idle workspaces, then least recently used states, until
+        `extra_bytes` more fit under the cap. False if they can't.
+        """
+        while self._used_bytes() + extra_bytes > self.max_bytes:
+            if self._workspaces:
+                self._workspace_bytes -= self._workspaces.pop(0).nbytes
+            elif self._entries:
+                self._release(next(iter(self._entries)))
+                self.evictions += 1
+            else:
+                return False
+        return True
+
+    # Stored states
+
+    def _release(self, key: str):
+        blocks, _ = self._entries.pop(key)
+        self._free.extend(int(b) for b in blocks[::-1])
+
+    def put(self, key: str, past: Dict[str, np.ndarray], past_len: int) -> bool:
+        """
+        Copy a KV state (arrays shaped (1, heads, >= past_len, head_dim)) into
+        the pool, evicting least recently used entries to make room. Returns
+        False if the state doesn't fit next to the workspaces in use.
+        """
+        needed = -(-past_len // self.block_tokens)
+
+        with self._lock:
+            if key in self._entries:
+                self._release(key)
+            if needed > self.num_blocks or not self._make_room(needed * self.block_bytes):
+                return False
+            while len(self._free) < needed:
+                self._release(next(iter(self._entries)))
+                self.evictions += 1
+
+            blocks = np.array([self._free.pop() for _ in range(needed)], dtype=np.int64)
+            self._entries[key] = (blocks, past_len)
+
+            padded = needed * self.block_tokens
+            for i, name in enumerate(self.names):
+                kv = past[name][0, :, :past_len]
+                if padded > past_len:
+                    kv = np.concatenate(
+                        [kv, np.zeros((self.kv_heads, padded - past_len, self.head_dim), dtype=kv.dtype)], axis=1
+                    )
+                # (heads, blocks*bt, dim) -> (blocks, heads, bt, dim)
+                tiles = kv.reshape(self.kv_heads, needed, self.block_tokens, self.head_dim).transpose(1, 0, 2, 3)
+
+                if self.quantized:
+                    scales = np.abs(tiles).max(axis=(2, 3)).astype(np.float32) / 127.0
+                    scales[scales == 0] = 1.0
+                    self._scales[i, blocks] = scales
+                    self._data[i, blocks] = np.rint(tiles / scales[:, :, None, None])
+                else:
+                    self._data[i, blocks] = tiles
+        return True
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, np.ndarray], int]]:
+        """(past, past_len) as fresh arrays in the model's dtype, or None if not cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            blocks, past_len = entry
+
+            past = {}
+            for i, name in enumerate(self.names):
+                tiles = self._data[i, blocks]
+                if self.quantized:
+                    tiles = tiles * self._scales[i, blocks][:, :, None, None]
+                kv = tiles.transpose(1, 0, 2, 3).reshape(self.kv_heads, -1, self.head_dim)[:, :past_len]
+                past[name] = np.ascontiguousarray(kv[None], dtype=self.kv_dtype)
+        return past, past_len
+
+    def discard(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                self._release(key)
+
+    # Decode workspaces
+
+    def acquire_workspace(self, tokens: int) -> KVWorkspace:
+        """
+        A decode workspace for at least `tokens` positions. Raises
+        MemoryError if it can't fit under the cap next to the workspaces
+        already in use.
+        """
+        with self._lock:
+            for ws in self._workspaces:
+                if ws.tokens >= tokens:
+                    self._workspaces.remove(ws)
+                    self._workspaces_in_use += 1
+                    return ws
+
+            nbytes = self._workspace_size(tokens)
+            in_use = self._workspace_bytes - sum(ws.nbytes for ws in self._workspaces)
+            if in_use + nbytes > self.max_bytes:
+                raise MemoryError(
+                    f"A {tokens}-token decode needs {nbytes / 2 ** 20:.0f} MB of KV workspace, "
+                    f"over the {self.max_bytes / 2 ** 20:.0f} MB cap"
+                )
+
+            if self._workspaces:
+                # Too small for this request; replace rather than keep both
+                self._workspace_bytes -= self._workspaces.pop().nbytes
+
+            # A decode can't run without its workspace, so stored states make way for it
+            self._make_room(nbytes)
+            # Round up so slightly longer requests reuse this one
+            tokens = -(-tokens // self.block_tokens) * self.block_tokens
+            ws = KVWorkspace(self.names, self.kv_heads, self.head_dim, self.kv_dtype, tokens)
+            self._workspace_bytes += ws.nbytes
+            self._workspaces_in_use += 1
+            return ws
+
+    def release_workspace(self, ws: KVWorkspace):
+        with self._lock:
+            self._workspaces_in_use -= 1
+            # Keep it for reuse only while everything still fits under the cap
+            if len(self._workspaces) < self.max_idle_workspaces and self._used_bytes() <= self.max_bytes:
+                self._workspaces.append(ws)
+            else:
+                self._workspace_bytes -= ws.nbytes
+
+    def stats(self) -> Dict:
+        with self._lock:
+            used = self._used_bytes()
+            rss = process_rss_bytes()
+            return {
+                "storage": self.storage_dtype.name,
+                "capacity_mb": round(self.max_bytes / 2 ** 20, 1),
+                "used_mb": round(used / 2 ** 20, 1),
+                "occupancy": round(used / self.max_bytes, 3) if self.max_bytes else 0.0,
+                "entries": len(self._entries),
+                "cached_tokens": sum(length for _, length in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "workspace_mb": round(self._workspace_bytes / 2 ** 20, 1),
+                "workspaces_in_use": self._workspaces_in_use,
+                "rss_mb": round(rss / 2 ** 20, 1) if rss is not None else None,
+            }
@@ -6,18 +6,94 @@ import onnxruntime as ort
 from transformers import AutoTokenizer
 import numpy as np
 from pathlib import Path
+import hashlib
 import json
-from typing import Dict, List
+import os
+import platform
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 import time
 
+from download_llm import verify_bundle
+from kv_cache import KVCacheManager
+from prompt_lookup import PromptLookupDrafter
+from sampling import Sampler
+from token_cache import PromptTokenCache
+
+# Cache key prefix of incremental-analysis conversations, one per caller session
+DELTA_CACHE_PREFIX = "session:"
+# Conversations kept at once; the least recently used is dropped beyond this
+MAX_DELTA_SESSIONS = 16
+
+# Fewest new tokens that can still hold a usable JSON assessment
+MIN_ANALYSIS_TOKENS = 60
+ANALYSIS_MAX_TOKENS = 300
+
+
+class ThroughputTracker:
+    """
+    Learns this host's prefill and decode speed (tokens/sec) so generations
+    can be sized to fit a time budget. Persisted across restarts.
+    """
+
+    def __init__(self, path: Path, host_key: str, alpha: float = 0.3):
+        self.path = path
+        self.host_key = host_key
+        self.alpha = alpha
+        self._lock = threading.Lock()
+
+        try:
+            self._all = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self._all = {}
+        self.stats = self._all.setdefault(host_key, {})
+
+    def _ewma(self, name: str, value: float):
+        old = self.stats.get(name)
+        self.stats[name] = value if old is None else (1 - self.alpha) * old + self.alpha * value
+
+    def update(self, prefill_tokens: int, prefill_s: float, decode_tokens: int, decode_s: float):
+        with self._lock:
+            if prefill_s > 0:
+                self._ewma("prefill_tps", prefill_tokens / prefill_s)
+            if decode_tokens > 0 and decode_s > 0:
+                self._ewma("decode_tps", decode_tokens / decode_s)
+
+            try:
+                # Per-process temp file: several engines (batch workers) may share this path
+                tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+                tmp.write_text(json.dumps(self._all, indent=2))
+                tmp.replace(self.path)
+            except OSError as e:
+                print(f"⚠️  Could not save throughput stats: {e}")
+
+    def plan_max_tokens(self, prompt_tokens: int, time_budget_s: float, max_tokens: int) -> int:
+        """Largest max_tokens expected to finish within the budget"""
+        # Until a speed has been observed, run uncapped and let the deadline cut us off
+        prefill_s = prompt_tokens / self.stats["prefill_tps"] if "prefill_tps" in self.stats else 0.0
+        decode_budget_s = time_budget_s * 0.9 - prefill_s
+        if decode_budget_s <= 0:
+            return 0
+        if "decode_tps" not in self.stats:
+            return max_tokens
+        return max(0, min(max_tokens, int(decode_budget_s * self.stats["decode_tps"])))
+
+
 class NPU_LLM_Engine:
-    def __init__(self):
+    def __init__(self, speculative: bool = True, intra_op_threads: Optional[int] = None,
+                 kv_cache_mb: Optional[int] = None, kv_storage: Optional[str] = None):
         print("🚀 Initializing LLM on Snapdragon X Elite NPU...")
         
         # Model path
         self.model_path = Path("models/phi3/cpu_and_mobile/cpu-int4-rtn-block-32-acc-level-4")
         
-        if not self.model_path.exists():
+        # Pre-optimized bundle written by download_llm.py for this machine's provider
+        preferred = 'DmlExecutionProvider' if 'DmlExecutionProvider' in ort.get_available_providers() else 'CPUExecutionProvider'
+        self.bundle_path = self._find_bundle(Path("models/bundle") / preferred)
+        
+        if not self.model_path.exists() and self.bundle_path is None:
             raise FileNotFoundError(
                 f"Model not found at {self.model_path}. "
                 "Please run download_llm.py first."
@@ -35,16 +111,28 @@ class NPU_LLM_Engine:
         
         # Load tokenizer
         print("Loading tokenizer...")
+        tokenizer_source = "microsoft/Phi-3-mini-4k-instruct"
+        if self.bundle_path is not None and (self.bundle_path / "tokenizer.json").exists():
+            tokenizer_source = str(self.bundle_path)
         self.tokenizer = AutoTokenizer.from_pretrained(
-            "microsoft/Phi-3-mini-4k-instruct",
+            tokenizer_source,
             trust_remote_code=True
         )
         
         # Load ONNX model
         print("Loading ONNX model...")
+        session_options = ort.SessionOptions()
+        if intra_op_threads:
+            # Several engines on one host (batch reports) must not each claim every core
+            session_options.intra_op_num_threads = intra_op_threads
         model_file = self.model_path / "phi3-mini-4k-instruct-cpu-int4-rtn-block-32-acc-level-4.onnx"
         
-        if not model_file.exists():
+        if self.bundle_path is not None:
+            # Graph is already optimized for this provider; skip doing it again on every start
+            model_file = self.bundle_path / "model.optimized.onnx"
+            session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            print(f"Using optimized bundle: {self.bundle_path}")
+        elif not model_file.exists():
             # Try to find the model file
             onnx_files = list(self.model_path.glob("*.onnx"))
             if onnx_files:
@@ -55,6 +143,7 @@ class NPU_LLM_Engine:
         
         self.session = ort.InferenceSession(
             str(model_file),
+            sess_options=session_options,
             providers=providers
         )
         
@@ -67,42 +156,414 @@ class NPU_LLM_Engine:
         else:
             print("⚠️  Running on CPU (NPU not available)")
         
+        self._inspect_model()
+        
+        # Longest prompt + answer an analysis conversation may grow to
+        self.max_context_tokens = 2048
+        
+        # Bounded memory for cached KV states (sessions, prompt prefixes) and decode buffers.
+        # Unless set, the cap fits a full-context decode plus two full-context stored states.
+        self.kv_cache = None
+        if self.past_names:
+            if kv_cache_mb is None and os.environ.get("CAMPUSGUARD_KV_CACHE_MB"):
+                kv_cache_mb = int(os.environ["CAMPUSGUARD_KV_CACHE_MB"])
+            self.kv_cache = KVCacheManager(
+                self.past_names, self.kv_heads, self.head_dim, self.kv_dtype,
+                max_bytes=kv_cache_mb * 2 ** 20 if kv_cache_mb else None,
+                storage=kv_storage or os.environ.get("CAMPUSGUARD_KV_STORAGE", "fp16"),
+                context_tokens=self.max_context_tokens
+            )
+            print(f"🧮 KV cache: {self.kv_cache.max_bytes / 2 ** 20:.0f} MB ({self.kv_cache.storage_dtype.name} storage)")
+        
+        # Per-line token memo for prompt construction, checked against full tokenization at first
+        self.prompt_tokens = PromptTokenCache(self.tokenizer)
+        self.token_checks_left = 3
+        
+        # Phi-3 ends a turn with <|end|>; stop on that as well as the real EOS
+        self.eos_token_ids = {self.tokenizer.eos_token_id}
+        end_id = self.tokenizer.convert_tokens_to_ids("<|end|>")
+        if isinstance(end_id, int) and end_id != self.tokenizer.unk_token_id:
+            self.eos_token_ids.add(end_id)
+        
+        # Thread-limited engines learn their own speeds so they don't skew the dashboard's
+        host_key = f"{platform.node()}|{actual_provider}"
+        if intra_op_threads:
+            host_key += f"|{intra_op_threads}t"
+        self.throughput = ThroughputTracker(Path("models") / "throughput.json", host_key)
+        self.budget_skips = 0
+        
+        # Prompt-lookup speculative decoding (greedy-exact, no draft model)
+        self.speculative = speculative
+        self.drafter = PromptLookupDrafter()
+        
+        # Conversation state carried between incremental analyses
+        self.rebaseline_every = 8
+        self._delta_states: "OrderedDict[str, Dict]" = OrderedDict()
+        self._delta_lock = threading.Lock()
+        
         self.initialized = True
     
-    def generate_text(self, prompt: str, max_tokens: int = 500) -> str:
+    def _find_bundle(self, bundle_path: Path) -> Optional[Path]:
+        """
+        Return the bundle directory if it was built for this ONNX Runtime version
+        and its files still match the hashes recorded when it was built
+        """
+        try:
+            info = json.loads((bundle_path / "bundle.json").read_text())
+        except (OSError, ValueError):
+            return None
+        
+        if info.get("onnxruntime") != ort.__version__:
+            print(f"⚠️  Bundle built for onnxruntime {info.get('onnxruntime')}, re-run download_llm.py")
+            return None
+        
+        bad = verify_bundle(bundle_path)
+        if bad:
+            print(f"⚠️  Bundle failed verification ({', '.join(bad)}), re-run download_llm.py")
+            return None
+        return bundle_path
+    
+    def _inspect_model(self):
         """
-        Generate text using the NPU-accelerated LLM
+        Discover the KV-cache inputs/outputs so generation can decode one token at a time
         """
-        # Tokenize input
-        inputs = self.tokenizer(prompt, return_tensors="np")
-        input_ids = inputs["input_ids"].astype(np.int64)
-        attention_mask = inputs["attention_mask"].astype(np.int64)
+        inputs = {i.name: i for i in self.session.get_inputs()}
+        output_names = [o.name for o in self.session.get_outputs()]
+        
+        self.input_names = set(inputs)
+        self.logits_name = "logits" if "logits" in output_names else output_names[0]
+        self.past_names = [n for n in inputs if n.startswith("past_key_values")]
+        self.present_names = [n.replace("past_key_values", "present") for n in self.past_names]
         
-        # Prepare inputs for ONNX
-        ort_inputs = {
-            "input_ids": input_ids,
-            "attention_mask": attention_mask
+        if not all(n in output_names for n in self.present_names):
+            print("⚠️  Model has no usable KV cache outputs; decoding without cache")
+            self.past_names, self.present_names = [], []
+        
+        if self.past_names:
+            meta = inputs[self.past_names[0]]
+            self.kv_heads, self.head_dim = meta.shape[1], meta.shape[3]
+            self.kv_dtype = np.float16 if "float16" in meta.type else np.float32
+    
+    def _empty_past(self) -> Dict[str, np.ndarray]:
+        return {
+            name: np.zeros((1, self.kv_heads, 0, self.head_dim), dtype=self.kv_dtype)
+            for name in self.past_names
         }
+    
+    def _forward(self, token_ids: np.ndarray, past: Dict[str, np.ndarray], past_len: int, run_options=None,
+                 out: Optional[Dict[str, np.ndarray]] = None):
+        """
+        Run one model step over token_ids given `past_len` cached positions.
+        Returns (logits, present KV keyed by past input name). With `out`,
+        the present KV is written into those preallocated arrays.
+        """
+        n = token_ids.shape[1]
+        feeds = {
+            "input_ids": token_ids,
+            "attention_mask": np.ones((1, past_len + n), dtype=np.int64),
+        }
+        if "position_ids" in self.input_names:
+            feeds["position_ids"] = np.arange(past_len, past_len + n, dtype=np.int64)[None, :]
+        feeds.update(past)
+        
+        if out is None:
+            outputs = self.session.run([self.logits_name] + self.present_names, feeds, run_options)
+            return outputs[0], dict(zip(self.past_names, outputs[1:]))
+        
+        binding = self.session.io_binding()
+        for name, value in feeds.items():
+            binding.bind_cpu_input(name, np.ascontiguousarray(value))
+        binding.bind_output(self.logits_name)
+        for past_name, present_name in zip(self.past_names, self.present_names):
+            buffer = out[past_name]
+            binding.bind_output(present_name, "cpu", 0, buffer.dtype, list(buffer.shape), buffer.ctypes.data)
+        self.session.run_with_iobinding(binding, run_options)
+        return binding.get_outputs()[0].numpy(), out
+    
+    def _tokenize(self, prompt: str, add_special_tokens: bool = True) -> np.ndarray:
+        return self.tokenizer(
+            prompt, return_tensors="np", add_special_tokens=add_special_tokens
+        )["input_ids"].astype(np.int64)
+    
+    def _encode_prompt(self, parts: List[str], groups: List[List[Tuple[str, str]]],
+                       add_special_tokens: bool = True, verify: bool = True) -> np.ndarray:
+        """
+        Token ids of parts[0] + "\n".join(lines of groups[0]) + parts[1] + ...
+        from memoized per-line tokens; (key, line) pairs are cached by key.
+        The first few results with `verify` are compared with tokenizing the
+        whole text, and the memo is switched off if this tokenizer doesn't
+        split cleanly at newlines.
+        """
+        # Read once: another thread may switch the memo off meanwhile
+        prompt_tokens = self.prompt_tokens
+        if prompt_tokens is not None:
+            input_ids = prompt_tokens.assemble(parts, groups, add_special_tokens)
+            if not verify or self.token_checks_left <= 0:
+                return input_ids
+            self.token_checks_left -= 1
+        
+        text = parts[0] + "".join(
+            "\n".join(line for _, line in group) + part for group, part in zip(groups, parts[1:])
+        )
+        expected = self._tokenize(text, add_special_tokens)
+        if prompt_tokens is not None and not np.array_equal(input_ids, expected):
+            print("⚠️  Line-by-line tokens differ from full tokenization, tokenizing whole prompts")
+            self.prompt_tokens = None
+        return expected
+    
+    def _analysis_prompt_ids(self, keyed_lines: List[Tuple[str, str]], yes_count: int, maybe_count: int,
+                             total: int, lookback_minutes: int, anomaly_text: str = "") -> np.ndarray:
+        head, tail = self._build_analysis_prompt(
+            "\0", yes_count, maybe_count, total, lookback_minutes, anomaly_text
+        ).split("\0")
+        return self._encode_prompt([head, tail], [keyed_lines])
+    
+    def _split_cached_prefix(self, input_ids: np.ndarray, prefix_text: str):
+        """
+        Return (remaining ids, past, past_len) with the KV of `prefix_text`
+        taken from the cache (prefilled and cached on first use). Falls back
+        to (input_ids, None, 0) if the prompt doesn't start with those tokens.
+        """
+        if self.kv_cache is None:
+            return input_ids, None, 0
+        
+        # Only used if it matches the start of input_ids, so it needs no check of its own
+        prefix_ids = self._encode_prompt([prefix_text], [], verify=False)
+        n = prefix_ids.shape[1]
+        if n >= input_ids.shape[1] or not np.array_equal(input_ids[0, :n], prefix_ids[0]):
+            return input_ids, None, 0
+        
+        key = "prefix:" + hashlib.sha1(prefix_ids.tobytes()).hexdigest()
+        cached = self.kv_cache.get(key)
+        if cached is None:
+            _, present = self._forward(prefix_ids, self._empty_past(), 0)
+            if not self.kv_cache.put(key, present, n):
+                print(f"⚠️  KV cache too small to keep the {n}-token prompt prefix")
+            cached = (present, n)
+        
+        past, past_len = cached
+        return input_ids[:, n:], past, past_len
+    
+    def _analysis_prefix(self, lookback_minutes: int) -> str:
+        """The fixed head of the analysis prompt, up to the first alert line"""
+        return self._build_analysis_prompt("\0", 0, 0, 0, lookback_minutes).split("\0")[0]
+    
+    def _generate_ids(self, input_ids: np.ndarray, max_tokens: int, deadline: Optional[float] = None,
+                      speculative: Optional[bool] = None, past: Optional[Dict[str, np.ndarray]] = None,
+                      past_len: int = 0, state_key: Optional[str] = None, sampler: Optional[Sampler] = None) -> Dict:
+        """
+        Greedy (or, with `sampler`, sampled) decode with a KV cache. If `deadline` (time.time()) is given,
+        decoding stops before the next step would overrun it, and an
+        in-flight session.run is terminated when it passes.
+        
+        With speculative decoding, tokens drafted by prompt lookup are
+        verified in the same forward pass as the pending token and the
+        longest prefix matching the greedy choice is kept, so the output is
+        identical to plain greedy decoding.
+        
+        `past`/`past_len` continue from a previously saved state. With
+        state_key, a generation that ends on EOS saves the KV cache up to
+        (not including) the EOS token under that key in self.kv_cache and
+        returns "state" with its length and that token as "pending", ready
+        to be prepended to the next turn.
+        
+        Present KV is written into a reused ping-pong workspace rather than
+        a freshly allocated array per step.
+        """
+        if speculative is None:
+            speculative = self.speculative
+        # Draft verification only reproduces plain argmax decoding
+        speculative = speculative and bool(self.past_names) and sampler is None
+        
+        run_options = ort.RunOptions()
+        timer = None
+        if deadline is not None:
+            timer = threading.Timer(max(deadline - time.time(), 0.0), setattr, (run_options, "terminate", True))
+            timer.daemon = True
+            timer.start()
         
-        # Run inference on NPU
+        generated: List[int] = []
+        stop_reason = "max_tokens"
+        prefill_s = 0.0
+        # Expected cost of the next decode step; prefill is far slower and must not stand in for it
+        decode_tps = self.throughput.stats.get("decode_tps")
+        decode_step_s = 1.0 / decode_tps if decode_tps else 0.0
+        drafted = accepted = 0
+        state = None
         start_time = time.time()
-        outputs = self.session.run(None, ort_inputs)
-        inference_time = time.time() - start_time
         
-        # Decode output
-        output_ids = outputs[0]
-        response = self.tokenizer.decode(output_ids[0], skip_special_tokens=True)
+        # Prompt + generated tokens, the lookup source for drafting
+        prompt_len = input_ids.shape[1]
+        room = self._decode_room()
+        if room is not None:
+            if past_len + prompt_len >= room:
+                raise MemoryError(f"{past_len + prompt_len} tokens of context don't fit under the KV cache cap")
+            max_tokens = min(max_tokens, room - past_len - prompt_len)
+        context = np.empty(prompt_len + max_tokens + self.drafter.num_draft + 1, dtype=np.int64)
+        context[:prompt_len] = input_ids[0]
         
-        print(f"⚡ NPU inference time: {inference_time:.2f}s")
+        workspace = None
+        if self.kv_cache is not None:
+            workspace = self.kv_cache.acquire_workspace(
+                past_len + prompt_len + max_tokens + self.drafter.num_draft + 1
+            )
+        out_side = 0
+        
+        try:
+            if past is None:
+                past, past_len = self._empty_past(), 0
+            ids = input_ids
+            
+            while len(generated) < max_tokens:
+                draft = context[:0]
+                if speculative and generated:
+                    draft = self.drafter.draft(context[:prompt_len + len(generated)])
+                    draft = draft[:max_tokens - len(generated)]
+                feed = np.concatenate([ids, draft[None, :]], axis=1) if draft.size else ids
+                
+                out = workspace.views(out_side, past_len + feed.shape[1]) if workspace is not None else None
+                step_start = time.time()
+                logits, present = self._forward(feed, past, past_len, run_options, out)
+                step_s = time.time() - step_start
+                if not generated:
+                    prefill_s = step_s
+                else:
+                    decode_step_s = step_s
+                
+                if sampler is not None:
+                    n_accepted = 0
+                    new_tokens = [sampler(logits[0, -1], context[:prompt_len + len(generated)])]
+                else:
+                    # Greedy choice after the pending token and after each drafted token
+                    preds = np.argmax(logits[0, -(draft.size + 1):], axis=-1)
+                    mismatch = np.flatnonzero(draft != preds[:draft.size])
+                    n_accepted = int(mismatch[0]) if mismatch.size else draft.size
+                    new_tokens = [int(t) for t in draft[:n_accepted]] + [int(preds[n_accepted])]
+                drafted += draft.size
+                accepted += n_accepted
+                
+                for j, token in enumerate(new_tokens):
+                    if token in self.eos_token_ids:
+                        stop_reason = "eos"
+                        if state_key is not None and self.kv_cache is not None:
+                            # new_tokens[:j] are accepted drafts, already in the cache
+                            kv_len = past_len + ids.shape[1] + j
+                            if self.kv_cache.put(state_key, present, kv_len):
+                                state = {"past_len": kv_len, "pending": token}
+                            else:
+                                print(f"⚠️  KV cache too small to keep the {kv_len}-token conversation, "
+                                      f"next analysis starts over")
+                        break
+                    context[prompt_len + len(generated)] = token
+                    generated.append(token)
+                    if len(generated) >= max_tokens:
+                        break
+                if stop_reason == "eos":
+                    break
+                
+                if self.past_names:
+                    # Only the pending token and accepted drafts have valid cache entries
+                    valid = past_len + ids.shape[1] + n_accepted
+                    if n_accepted < draft.size:
+                        present = {name: kv[:, :, :valid] for name, kv in present.items()}
+                        if workspace is not None:
+                            # Compact into the other side so the next past is contiguous;
+                            # the next present then goes back to this side
+                            compact = workspace.views(1 - out_side, valid)
+                            for name, kv in present.items():
+                                np.copyto(compact[name], kv)
+                            present = compact
+                    elif workspace is not None:
+                        out_side = 1 - out_side
+                    past, past_len = present, valid
+                    ids = np.array([[new_tokens[-1]]], dtype=np.int64)
+                else:
+                    ids = np.concatenate([ids, [[new_tokens[-1]]]], axis=1)
+                
+                if deadline is not None and time.time() + decode_step_s > deadline:
+                    stop_reason = "deadline"
+                    break
+        except Exception:
+            if not run_options.terminate:
+                raise
+            stop_reason = "deadline"
+            if not generated:
+                # Cut off during prefill: the elapsed time is still a useful speed bound
+                prefill_s = time.time() - start_time
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if workspace is not None:
+                self.kv_cache.release_workspace(workspace)
+        
+        total_s = time.time() - start_time
+        decode_steps = max(len(generated) - 1 + (stop_reason == "eos"), 0)
+        if prefill_s > 0:
+            self.throughput.update(input_ids.shape[1], prefill_s, decode_steps, total_s - prefill_s)
         
-        return response
+        if speculative:
+            self.drafter.remember(generated, drafted, accepted)
+        
+        return {
+            "text": self.tokenizer.decode(generated, skip_special_tokens=True),
+            "tokens": len(generated),
+            "stop_reason": stop_reason,
+            "prefill_s": prefill_s,
+            "total_s": total_s,
+            "drafted": drafted,
+            "accepted": accepted,
+            "state": state,
+            "sample_s": sampler.elapsed_s if sampler is not None else 0.0,
+        }
     
-    def analyze_alerts(self, alert_text: str, yes_count: int, maybe_count: int, total: int, lookback_minutes: int) -> Dict:
+    def generate_text(self, prompt: str, max_tokens: int = 500, time_budget_s: Optional[float] = None,
+                      temperature: float = 0.0, top_k: int = 0, top_p: float = 1.0,
+                      repetition_penalty: float = 1.0, seed: Optional[int] = None) -> str:
         """
-        Analyze security alerts using NPU-accelerated LLM
+        Generate text using the NPU-accelerated LLM.
+        
+        Greedy by default; temperature > 0 samples (optionally with top-k /
+        top-p), and a seed makes sampling reproducible.
         """
+        deadline = time.time() + time_budget_s if time_budget_s else None
+        input_ids = self._tokenize(prompt)
+        
+        if time_budget_s:
+            max_tokens = self.throughput.plan_max_tokens(input_ids.shape[1], time_budget_s, max_tokens)
+        
+        sampler = None
+        if temperature > 0 or repetition_penalty != 1.0:
+            sampler = Sampler(temperature, top_k, top_p, repetition_penalty, seed)
         
-        prompt = f"""<|system|>
+        result = self._generate_ids(input_ids, max_tokens, deadline, sampler=sampler)
+        self._log_generation(result)
+        return result["text"]
+    
+    def _log_generation(self, result: Dict):
+        decode_s = result["total_s"] - result["prefill_s"]
+        tps = (result["tokens"] - 1) / decode_s if result["tokens"] > 1 and decode_s > 0 else 0.0
+        drafts = f", {result['accepted']}/{result['drafted']} drafts accepted" if result["drafted"] else ""
+        sampling = ""
+        if result["sample_s"]:
+            sampling = f", sampling {100 * result['sample_s'] / result['total_s']:.1f}% of time"
+        print(
+            f"⚡ NPU inference time: {result['total_s']:.2f}s "
+            f"({result['tokens']} tokens, {tps:.1f} tok/s{drafts}{sampling}, stop: {result['stop_reason']})"
+        )
+    
+    def _anomaly_section(self, anomaly_text: str) -> str:
+        if not anomaly_text:
+            return ""
+        return f"""
+ANOMALIES (alert rate vs device baseline):
+{anomaly_text}
+"""
+    
+    def _build_analysis_prompt(self, alert_text: str, yes_count: int, maybe_count: int, total: int,
+                               lookback_minutes: int, anomaly_text: str = "") -> str:
+        anomaly_section = self._anomaly_section(anomaly_text)
+        
+        return f"""<|system|>
 You are a campus security AI assistant analyzing real-time safety alerts. Provide threat assessment in strict JSON format.
 <|end|>
 <|user|>
@@ -114,7 +575,7 @@ STATISTICS:
 - Total alerts: {total}
 - Confirmed threats (YES): {yes_count}
 - Uncertain (MAYBE): {maybe_count}
-
+{anomaly_section}
 Provide your assessment as a JSON object with these exact fields:
 {{
   "threat_level": "CRITICAL" or "HIGH" or "MEDIUM" or "LOW",
@@ -127,98 +588,431 @@ Respond ONLY with the JSON object, no other text.
 <|end|>
 <|assistant|>
 """
+    
+    def _build_delta_segment(self, new_lines: List[str], expired_lines: List[str], yes_count: int,
+                             maybe_count: int, total: int, lookback_minutes: int, anomaly_text: str = "") -> str:
+        """
+        Follow-up user turn appended after the previous assessment (and its <|end|>)
+        """
+        new_text = "\n".join(new_lines) or "- none"
+        expired_text = "\n".join(expired_lines) or "- none"
+        anomaly_section = self._anomaly_section(anomaly_text)
+        
+        return f"""
+<|user|>
+Update: the alerts from the last {lookback_minutes} minutes changed since your previous assessment.
+
+NEW OR UPDATED ALERTS:
+{new_text}
+
+EXPIRED (now outside the window):
+{expired_text}
 
+STATISTICS:
+- Total alerts: {total}
+- Confirmed threats (YES): {yes_count}
+- Uncertain (MAYBE): {maybe_count}
+{anomaly_section}
+Provide your updated assessment as the same JSON object. Respond ONLY with the JSON object, no other text.
+<|end|>
+<|assistant|>
+"""
+    
+    def _delta_segment_ids(self, new_lines: List[Tuple[str, str]], expired_lines: List[Tuple[str, str]],
+                           yes_count: int, maybe_count: int, total: int, lookback_minutes: int,
+                           anomaly_text: str = "") -> np.ndarray:
+        segment = self._build_delta_segment(["\0"], ["\1"], yes_count, maybe_count, total, lookback_minutes, anomaly_text)
+        head, rest = segment.split("\0")
+        middle, tail = rest.split("\1")
+        none = [("none", "- none")]
+        return self._encode_prompt([head, middle, tail], [new_lines or none, expired_lines or none],
+                                   add_special_tokens=False)
+    
+    def _decode_room(self) -> Optional[int]:
+        """Most past + prompt + new tokens one generation can hold under the KV cache cap"""
+        if self.kv_cache is None:
+            return None
+        return self.kv_cache.max_decode_tokens() - self.drafter.num_draft - 1
+    
+    def _fit_prompt_to_budget(self, lines: List[Tuple[str, str]], build_ids, time_budget_s: Optional[float]):
+        """
+        Pick the least-compacted prompt whose generation fits the time budget
+        and the KV cache cap.
+        `lines` are (key, alert line) pairs and build_ids turns a subset into input_ids.
+        Compaction keeps the first N alert lines (newest first) and notes how many were omitted.
+        Returns (input_ids, max_tokens, kept_lines), or (None, 0, 0) if nothing fits.
+        """
+        input_ids = None
+        room = self._decode_room()
+        levels = sorted({len(lines), len(lines) // 2, min(len(lines), 10), 0}, reverse=True)
+        
+        for level, keep in enumerate(levels):
+            kept = lines[:keep]
+            if keep < len(lines):
+                note = f"- ... {len(lines) - keep} more alerts omitted"
+                kept.append((note, note))
+            input_ids = build_ids(kept)
+            
+            max_tokens = ANALYSIS_MAX_TOKENS
+            if room is not None:
+                max_tokens = min(max_tokens, room - input_ids.shape[1])
+            if time_budget_s:
+                max_tokens = self.throughput.plan_max_tokens(input_ids.shape[1], time_budget_s, max_tokens)
+            if max_tokens >= MIN_ANALYSIS_TOKENS:
+                if level > 0:
+                    limit = f"{time_budget_s:.0f}s budget" if time_budget_s else "KV cache"
+                    print(f"✂️  Compacted prompt to {keep}/{len(lines)} alert lines to fit {limit}")
+                self.budget_skips = 0
+                return input_ids, max_tokens, keep
+        
+        # Even the shortest prompt overflows the KV cache; retrying won't help
+        if room is not None and input_ids.shape[1] + MIN_ANALYSIS_TOKENS > room:
+            return None, 0, 0
+        
+        # Re-probe now and then so a stale, pessimistic speed estimate can recover
+        self.budget_skips += 1
+        if self.budget_skips >= 10:
+            self.budget_skips = 0
+            return input_ids, MIN_ANALYSIS_TOKENS, keep
+        return None, 0, 0
+    
+    def analyze_alerts(self, alert_text: str, yes_count: int, maybe_count: int, total: int, lookback_minutes: int,
+                       anomaly_text: str = "", time_budget_s: Optional[float] = None) -> Dict:
+        """
+        Analyze security alerts using NPU-accelerated LLM.
+        
+        With time_budget_s, the prompt and token budget are sized from this
+        host's learned throughput and decoding is cut off at the deadline;
+        a truncated answer is salvaged if possible, otherwise the rule-based
+        result is returned.
+        """
+        deadline = time.time() + time_budget_s if time_budget_s else None
+        
         print(f"\n🧠 Analyzing {total} alerts on NPU...")
         
         try:
-            # Generate response using NPU
-            response = self.generate_text(prompt, max_tokens=300)
-            
-            # Extract JSON from response
-            response = response.strip()
-            
-            # Find JSON in response
-            start = response.find('{')
-            end = response.rfind('}') + 1
-            
-            if start == -1 or end == 0:
-                print("⚠️  No JSON found in response, using fallback")
-                return self._fallback_analysis(yes_count, maybe_count, total)
+            # Without alert ids, identical lines share a memo entry
+            lines = [(line, line) for line in alert_text.split("\n")] if alert_text else []
+            input_ids, max_tokens, _ = self._fit_prompt_to_budget(
+                lines,
+                lambda kept: self._analysis_prompt_ids(kept, yes_count, maybe_count, total, lookback_minutes, anomaly_text),
+                time_budget_s
+            )
+            if input_ids is None:
+                print("⏱️  No prompt fits the time budget and KV cache on this host, using fallback")
+                return self._fallback_analysis(yes_count, maybe_count, total, anomaly_text)
             
-            json_str = response[start:end]
-            result = json.loads(json_str)
+            # The system/instruction head is the same every tick; reuse its KV
+            input_ids, past, past_len = self._split_cached_prefix(input_ids, self._analysis_prefix(lookback_minutes))
             
-            # Validate required fields
-            required = ["threat_level", "summary", "recommendations", "alert_security"]
-            if not all(k in result for k in required):
-                print("⚠️  Invalid JSON structure, using fallback")
-                return self._fallback_analysis(yes_count, maybe_count, total)
+            # Generate response using NPU
+            generation = self._generate_ids(input_ids, max_tokens, deadline, past=past, past_len=past_len)
+            self._log_generation(generation)
             
-            print("✅ NPU analysis complete")
-            result["npu_processed"] = True
-            return result
+            return self._result_from_generation(generation, yes_count, maybe_count, total, anomaly_text)
             
         except Exception as e:
             print(f"❌ NPU analysis error: {e}")
             print("Using fallback analysis...")
-            return self._fallback_analysis(yes_count, maybe_count, total)
+            return self._fallback_analysis(yes_count, maybe_count, total, anomaly_text)
+    
+    def analyze_alerts_incremental(self, alert_lines: Dict[str, str], yes_count: int, maybe_count: int, total: int,
+                                   lookback_minutes: int, anomaly_text: str = "",
+                                   time_budget_s: Optional[float] = None, session_id: str = "default") -> Dict:
+        """
+        Like analyze_alerts, but keeps the KV cache of the previous analysis
+        (prompt plus assessment) and only prefills what changed since then:
+        new or updated alert lines (keyed by alert id) and expirations.
+        Re-baselines with a full prompt every `rebaseline_every` ticks or when
+        the conversation would outgrow `max_context_tokens`.
+        
+        Each `session_id` (one per dashboard session) has its own conversation.
+        """
+        deadline = time.time() + time_budget_s if time_budget_s else None
+        cache_key = DELTA_CACHE_PREFIX + session_id
+        
+        with self._delta_lock:
+            state = self._delta_states.get(session_id)
+            if state is not None and state["turns"] >= self.rebaseline_every:
+                state = None
+            
+            if state is not None:
+                previous = state["alert_lines"]
+                new_lines = [(key, line) for key, line in alert_lines.items() if previous.get(key) != line]
+                expired_lines = [(key, line) for key, line in previous.items() if key not in alert_lines]
+                
+                # Nothing changed since the last tick: the last assessment still stands
+                if (not new_lines and not expired_lines
+                        and state["inputs"] == (yes_count, maybe_count, total, lookback_minutes, anomaly_text)):
+                    print("♻️  No alert changes since last analysis, reusing assessment")
+                    return dict(state["result"])
+                
+                # The conversation's KV may have been evicted under memory pressure
+                cached = self.kv_cache.get(cache_key)
+                if cached is None:
+                    print("🧹 Cached conversation was evicted")
+                    state = None
+            
+            print(f"\n🧠 Analyzing {total} alerts on NPU (incremental)...")
+            
+            try:
+                if state is not None:
+                    input_ids = np.concatenate(
+                        [[[state["pending"]]], self._delta_segment_ids(new_lines, expired_lines, yes_count, maybe_count,
+                                                                       total, lookback_minutes, anomaly_text)], axis=1
+                    )
+                    room = self._decode_room()
+                    limit = self.max_context_tokens if room is None else min(self.max_context_tokens, room)
+                    if state["past_len"] + input_ids.shape[1] + ANALYSIS_MAX_TOKENS > limit:
+                        state = None
+                
+                if state is None:
+                    print("🔄 Re-baselining incremental analysis with a full prompt")
+                    self._drop_delta_state(session_id)
+                    input_ids, max_tokens, kept = self._fit_prompt_to_budget(
+                        list(alert_lines.items()),
+                        lambda kept: self._analysis_prompt_ids(kept, yes_count, maybe_count, total, lookback_minutes, anomaly_text),
+                        time_budget_s
+                    )
+                    past, past_len, turns = None, 0, 0
+                    if input_ids is not None:
+                        input_ids, past, past_len = self._split_cached_prefix(
+                            input_ids, self._analysis_prefix(lookback_minutes)
+                        )
+                else:
+                    print(f"➕ {len(new_lines)} new/updated, {len(expired_lines)} expired "
+                          f"({input_ids.shape[1]} tokens on top of {state['past_len']} cached)")
+                    max_tokens, kept = ANALYSIS_MAX_TOKENS, len(alert_lines)
+                    if time_budget_s:
+                        max_tokens = self.throughput.plan_max_tokens(input_ids.shape[1], time_budget_s, ANALYSIS_MAX_TOKENS)
+                        if max_tokens < MIN_ANALYSIS_TOKENS:
+                            input_ids = None
+                    past, past_len = cached
+                    turns = state["turns"] + 1
+                
+                if input_ids is None:
+                    # Keep any cached state; these alerts are picked up on the next tick
+                    print("⏱️  No prompt fits the time budget and KV cache on this host, using fallback")
+                    return self._fallback_analysis(yes_count, maybe_count, total, anomaly_text)
+                
+                generation = self._generate_ids(input_ids, max_tokens, deadline, past=past, past_len=past_len,
+                                                state_key=cache_key)
+                self._log_generation(generation)
+                result = self._result_from_generation(generation, yes_count, maybe_count, total, anomaly_text)
+                
+                # Only a complete answer over the complete alert set is safe to build on
+                if (generation["state"] is not None and result["npu_processed"]
+                        and not result.get("partial") and kept == len(alert_lines)):
+                    self._delta_states[session_id] = dict(
+                        generation["state"],
+                        alert_lines=dict(alert_lines),
+                        inputs=(yes_count, maybe_count, total, lookback_minutes, anomaly_text),
+                        result=dict(result),
+                        turns=turns
+                    )
+                    self._delta_states.move_to_end(session_id)
+                    while len(self._delta_states) > MAX_DELTA_SESSIONS:
+                        self._drop_delta_state(next(iter(self._delta_states)))
+                else:
+                    self._drop_delta_state(session_id)
+                return result
+                
+            except Exception as e:
+                self._drop_delta_state(session_id)
+                print(f"❌ NPU analysis error: {e}")
+                print("Using fallback analysis...")
+                return self._fallback_analysis(yes_count, maybe_count, total, anomaly_text)
+    
+    def _drop_delta_state(self, session_id: str):
+        self._delta_states.pop(session_id, None)
+        if self.kv_cache is not None:
+            self.kv_cache.discard(DELTA_CACHE_PREFIX + session_id)
+    
+    def _result_from_generation(self, generation: Dict, yes_count: int, maybe_count: int, total: int,
+                                anomaly_text: str = "") -> Dict:
+        # Extract JSON from response
+        response = generation["text"].strip()
+        
+        result = self._parse_analysis(response)
+        if result is None and generation["stop_reason"] != "eos":
+            result = self._parse_partial_analysis(response, yes_count, maybe_count, total, anomaly_text)
+            if result is not None:
+                print("⏱️  Generation cut short, using partially parsed assessment")
+                return result
+        
+        if result is None:
+            print("⚠️  No valid JSON in response, using fallback")
+            return self._fallback_analysis(yes_count, maybe_count, total, anomaly_text)
+        
+        print("✅ NPU analysis complete")
+        result["npu_processed"] = True
+        return result
+    
+    def _parse_analysis(self, response: str) -> Optional[Dict]:
+        """
+        Extract the complete JSON assessment from a response, or None
+        """
+        # Find JSON in response
+        start = response.find('{')
+        end = response.rfind('}') + 1
+        
+        if start == -1 or end == 0:
+            return None
+        
+        try:
+            result = json.loads(response[start:end])
+        except ValueError:
+            return None
+        
+        # Validate required fields
+        required = ["threat_level", "summary", "recommendations", "alert_security"]
+        if not isinstance(result, dict) or not all(k in result for k in required):
+            return None
+        
+        return result
     
-    def _fallback_analysis(self, yes_count: int, maybe_count: int, total: int) -> Dict:
+    def _parse_partial_analysis(self, response: str, yes_count: int, maybe_count: int, total: int,
+                                anomaly_text: str = "") -> Optional[Dict]:
+        """
+        Salvage whatever complete fields a truncated JSON response contains,
+        filling the rest from the rule-based result. Needs at least threat_level.
+        """
+        level = re.search(r'"threat_level"\s*:\s*"(CRITICAL|HIGH|MEDIUM|LOW)"', response)
+        if not level:
+            return None
+        
+        result = self._fallback_analysis(yes_count, maybe_count, total, anomaly_text)
+        result["threat_level"] = level.group(1)
+        result["alert_security"] = level.group(1) in ("CRITICAL", "HIGH")
+        
+        summary = re.search(r'"summary"\s*:\s*"((?:[^"\\]|\\.)*)"', response)
+        if summary:
+            result["summary"] = json.loads(f'"{summary.group(1)}"')
+        
+        recs = re.search(r'"recommendations"\s*:\s*\[(.*?)(?:\]|$)', response, re.S)
+        if recs:
+            items = [json.loads(f'"{r}"') for r in re.findall(r'"((?:[^"\\]|\\.)*)"', recs.group(1))]
+            if items:
+                result["recommendations"] = items
+        
+        flag = re.search(r'"alert_security"\s*:\s*(true|false)', response)
+        if flag:
+            result["alert_security"] = flag.group(1) == "true"
+        
+        result["npu_processed"] = True
+        result["partial"] = True
+        return result
+    
+    def _fallback_analysis(self, yes_count: int, maybe_count: int, total: int, anomaly_text: str = "") -> Dict:
         """
         Fallback rule-based analysis if LLM fails
         """
-        if yes_count >= 3:
-            return {
-                "threat_level": "CRITICAL",
-                "summary": f"🚨 {yes_count} confirmed threats detected. Immediate response required.",
-                "recommendations": [
-                    "🚨 Dispatch security immediately",
-                    "📞 Contact campus police",
-                    "📹 Review all camera feeds",
-                    "🔒 Prepare lockdown procedures"
-                ],
-                "alert_security": True,
-                "npu_processed": False
-            }
-        elif yes_count >= 1:
-            return {
-                "threat_level": "HIGH",
-                "summary": f"⚠️ {yes_count} confirmed, {maybe_count} uncertain incidents.",
-                "recommendations": [
-                    "👮 Increase security patrols",
-                    "📱 Notify supervisor",
-                    "🔍 Investigate incidents"
-                ],
-                "alert_security": True,
-                "npu_processed": False
-            }
-        elif maybe_count >= 1:
-            return {
-                "threat_level": "MEDIUM",
-                "summary": f"Moderate activity: {maybe_count} alerts need verification.",
-                "recommendations": [
-                    "🔍 Verify uncertain alerts",
-                    "👁️ Maintain awareness",
-                    "📋 Document incidents"
-                ],
-                "alert_security": False,
-                "npu_processed": False
-            }
-        else:
-            return {
-                "threat_level": "LOW",
-                "summary": "✅ Normal operations. No threats.",
-                "recommendations": ["✓ Continue monitoring"],
-                "alert_security": False,
-                "npu_processed": False
-            }
+        return fallback_analysis(yes_count, maybe_count, total, anomaly_text)
+
+    def get_status(self) -> Dict:
+        """
+        Report which execution provider the engine is running on
+        """
+        return {
+            "provider": self.session.get_providers()[0],
+            "initialized": self.initialized,
+            "model": str(self.bundle_path or self.model_path),
+            "throughput": dict(self.throughput.stats),
+            "incremental": {
+                "sessions": len(self._delta_states),
+                "cached_tokens": sum(state["past_len"] for state in list(self._delta_states.values())),
+            },
+            "speculative": {
+                "enabled": self.speculative,
+                "acceptance_rate": round(self.drafter.acceptance_rate, 3),
+            },
+            "kv_cache": self.kv_cache.stats() if self.kv_cache is not None else None,
+            "prompt_tokens": self.prompt_tokens.stats() if self.prompt_tokens is not None else None,
+        }
+
+
+def fallback_analysis(yes_count: int, maybe_count: int, total: int, anomaly_text: str = "") -> Dict:
+    """
+    Fallback rule-based analysis if LLM fails
+    """
+    result = _rule_based_analysis(yes_count, maybe_count, total)
+    
+    # Devices spiking above their own baseline lift a quiet assessment to MEDIUM
+    if anomaly_text:
+        spiking = anomaly_text.count("\n") + 1
+        if result["threat_level"] == "LOW":
+            result["threat_level"] = "MEDIUM"
+            result["summary"] = f"Unusual activity: {spiking} device/event pairs spiking above baseline."
+            result["recommendations"] = []
+        if result["threat_level"] == "MEDIUM":
+            result["recommendations"].append("📈 Check cameras on spiking devices")
+    
+    return result
+
+
+def _rule_based_analysis(yes_count: int, maybe_count: int, total: int) -> Dict:
+    if yes_count >= 3:
+        return {
+            "threat_level": "CRITICAL",
+            "summary": f"🚨 {yes_count} confirmed threats detected. Immediate response required.",
+            "recommendations": [
+                "🚨 Dispatch security immediately",
+                "📞 Contact campus police",
+                "📹 Review all camera feeds",
+                "🔒 Prepare lockdown procedures"
+            ],
+            "alert_security": True,
+            "npu_processed": False
+        }
+    elif yes_count >= 1:
+        return {
+            "threat_level": "HIGH",
+            "summary": f"⚠️ {yes_count} confirmed, {maybe_count} uncertain incidents.",
+            "recommendations": [
+                "👮 Increase security patrols",
+                "📱 Notify supervisor",
+                "🔍 Investigate incidents"
+            ],
+            "alert_security": True,
+            "npu_processed": False
+        }
+    elif maybe_count >= 1:
+        return {
+            "threat_level": "MEDIUM",
+            "summary": f"Moderate activity: {maybe_count} alerts need verification.",
+            "recommendations": [
+                "🔍 Verify uncertain alerts",
+                "👁️ Maintain awareness",
+                "📋 Document incidents"
+            ],
+            "alert_security": False,
+            "npu_processed": False
+        }
+    else:
+        return {
+            "threat_level": "LOW",
+            "summary": "✅ Normal operations. No threats.",
+            "recommendations": ["✓ Continue monitoring"],
+            "alert_security": False,
+            "npu_processed": False
+        }
 
 # Singleton instance
 _npu_engine = None
 
 def get_npu_engine():
-    """Get or create NPU LLM engine"""
+    """
+    Get or create NPU LLM engine.
+
+    If CAMPUSGUARD_WORKER is set (e.g. "127.0.0.1:8790"), returns a client for
+    the shared inference worker instead of loading the model in this process.
+    """
     global _npu_engine
     if _npu_engine is None:
-        _npu_engine = NPU_LLM_Engine()
-    return _npu_engine
\ No newline at end of file
+        worker_address = os.environ.get("CAMPUSGUARD_WORKER")
+        if worker_address:
+            from inference_worker import InferenceClient
+            _npu_engine = InferenceClient(worker_address)
+        else:
+            _npu_engine = NPU_LLM_Engine()
+    return _npu_engine
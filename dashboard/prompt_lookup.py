@@ -0,0 +1,85 @@
+"""
+Prompt-lookup drafting for speculative decoding
+
+The analysis JSON mostly copies key names, threat levels, device ids and
+stock recommendation phrases from the prompt or from earlier answers. The
+drafter proposes the tokens that followed the most recent occurrence of
+the current n-gram; the engine then verifies them all in one forward pass.
+No draft model is needed.
+"""
+
+import threading
+from collections import deque
+from typing import List
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class PromptLookupDrafter:
+    def __init__(self, max_ngram: int = 3, min_ngram: int = 1, num_draft: int = 8, history_size: int = 16):
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.num_draft = num_draft
+        self.history = deque(maxlen=history_size)
+        # Shared by concurrent generations (sharded analysis, worker connections)
+        self._lock = threading.Lock()
+
+        # Acceptance counters, reported through the engine status
+        self.drafted = 0
+        self.accepted = 0
+
+    def remember(self, output_ids: List[int], drafted: int = 0, accepted: int = 0):
+        """
+        Keep a finished output as an extra lookup source for future requests
+        and add its draft/accept counts
+        """
+        with self._lock:
+            self.drafted += drafted
+            self.accepted += accepted
+            if output_ids:
+                self.history.append(np.asarray(output_ids, dtype=np.int64))
+
+    @staticmethod
+    def _lookup(source: np.ndarray, pattern: np.ndarray, num_draft: int) -> np.ndarray:
+        """
+        Tokens following the latest occurrence of `pattern` in `source` that
+        has at least one follower, or an empty array
+        """
+        n = pattern.size
+        if source.size <= n:
+            return source[:0]
+
+        windows = sliding_window_view(source[:-1], n)
+        starts = np.flatnonzero((windows == pattern).all(axis=1))
+        if starts.size == 0:
+            return source[:0]
+
+        follow = starts[-1] + n
+        return source[follow:follow + num_draft]
+
+    def draft(self, context: np.ndarray) -> np.ndarray:
+        """
+        Propose up to num_draft tokens continuing `context` (prompt + generated so far)
+        """
+        with self._lock:
+            history = tuple(self.history)
+
+        for n in range(min(self.max_ngram, context.size - 1), self.min_ngram - 1, -1):
+            pattern = context[-n:]
+
+            # Search the context itself; the trailing pattern has no follower so never matches itself
+            candidate = self._lookup(context, pattern, self.num_draft)
+            if candidate.size:
+                return candidate
+
+            for past_output in reversed(history):
+                candidate = self._lookup(past_output, pattern, self.num_draft)
+                if candidate.size:
+                    return candidate
+
+        return context[:0]
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
@@ -0,0 +1,167 @@
+"""
+Logits processing and sampling for the decode loop
+
+A processor is any callable (scores, candidates, context) -> candidates:
+`scores` is a float32 working copy of the step's logits (full vocab),
+`candidates` an index array of tokens still in play (None = all of them)
+and `context` the prompt plus tokens generated so far. Transforms edit
+scores in place; filters return fewer candidates. Filtering uses
+argpartition on the vocab and only ever sorts the surviving candidates.
+"""
+
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+Processor = Callable[[np.ndarray, Optional[np.ndarray], np.ndarray], Optional[np.ndarray]]
+
+
+class RepetitionPenalty:
+    """CTRL-style penalty on every token already in the context"""
+
+    def __init__(self, penalty: float):
+        self.penalty = penalty
+
+    def __call__(self, scores, candidates, context):
+        if context.size:
+            # Duplicate ids just write the same value twice
+            seen = scores[context]
+            scores[context] = np.where(seen > 0, seen / self.penalty, seen * self.penalty)
+        return candidates
+
+
+class TopK:
+    def __init__(self, k: int):
+        self.k = k
+
+    def __call__(self, scores, candidates, context):
+        if candidates is None:
+            if self.k >= scores.size:
+                return None
+            return np.argpartition(scores, scores.size - self.k)[scores.size - self.k:]
+        if self.k >= candidates.size:
+            return candidates
+        values = scores[candidates]
+        return candidates[np.argpartition(values, values.size - self.k)[values.size - self.k:]]
+
+
+class Temperature:
+    def __init__(self, temperature: float):
+        self.temperature = temperature
+
+    def __call__(self, scores, candidates, context):
+        if candidates is None:
+            scores /= self.temperature
+        else:
+            scores[candidates] /= self.temperature
+        return candidates
+
+
+class TopP:
+    """
+    Nucleus filter. Over the full vocab it grows a partial selection until
+    it holds `p` of the probability mass instead of sorting 32k logits.
+    """
+
+    def __init__(self, p: float, min_keep: int = 1, initial_k: int = 64):
+        self.p = p
+        self.min_keep = min_keep
+        self.initial_k = initial_k
+        self._exp = None
+
+    def _nucleus(self, sorted_probs: np.ndarray, total: float) -> int:
+        """How many of the (descending) probabilities are needed to reach p"""
+        cumulative = np.cumsum(sorted_probs)
+        n = int(np.searchsorted(cumulative, self.p * total)) + 1
+        return max(n, self.min_keep)
+
+    def __call__(self, scores, candidates, context):
+        if candidates is not None:
+            values = scores[candidates]
+            order = np.argsort(values)[::-1]
+            probs = np.exp(values[order] - values[order[0]])
+            return candidates[order[:self._nucleus(probs, probs.sum())]]
+
+        if self._exp is None or self._exp.size != scores.size:
+            self._exp = np.empty_like(scores)
+        np.subtract(scores, scores.max(), out=self._exp)
+        np.exp(self._exp, out=self._exp)
+        total = float(self._exp.sum())
+
+        k = min(self.initial_k, scores.size)
+        while True:
+            top = np.argpartition(self._exp, scores.size - k)[scores.size - k:] if k < scores.size else np.arange(k)
+            top = top[np.argsort(self._exp[top])[::-1]]
+            probs = self._exp[top]
+            if k == scores.size or probs.sum() >= self.p * total:
+                return top[:min(self._nucleus(probs, total), k)]
+            k = min(k * 4, scores.size)
+
+
+class Sampler:
+    """
+    Next-token chooser for NPU_LLM_Engine._generate_ids.
+
+    temperature 0 means greedy (after any repetition penalty). Extra
+    processors run before the built-in ones. Seeded samplers are
+    deterministic for the same prompt and settings.
+    """
+
+    def __init__(self, temperature: float = 1.0, top_k: int = 0, top_p: float = 1.0,
+                 repetition_penalty: float = 1.0, seed: Optional[int] = None,
+                 processors: Optional[List[Processor]] = None):
+        self.greedy = temperature <= 0
+        self.rng = np.random.default_rng(seed)
+
+        # top-k does not depend on temperature, so it runs first and temperature only touches k scores
+        self.processors: List[Processor] = list(processors or [])
+        if repetition_penalty != 1.0:
+            self.processors.append(RepetitionPenalty(repetition_penalty))
+        if not self.greedy:
+            if top_k > 0:
+                self.processors.append(TopK(top_k))
+            if temperature != 1.0:
+                self.processors.append(Temperature(temperature))
+            if top_p < 1.0:
+                self.processors.append(TopP(top_p))
+
+        self._scores = None
+        self._work = None
+
+        # Time spent here per generation, to compare against session.run
+        self.elapsed_s = 0.0
+        self.calls = 0
+
+    def __call__(self, logits: np.ndarray, context: np.ndarray) -> int:
+        start = time.perf_counter()
+
+        if self._scores is None or self._scores.size != logits.size:
+            self._scores = np.empty(logits.size, dtype=np.float32)
+            self._work = np.empty(logits.size, dtype=np.float32)
+        scores = self._scores
+        np.copyto(scores, logits)
+
+        candidates = None
+        for processor in self.processors:
+            candidates = processor(scores, candidates, context)
+
+        if self.greedy:
+            token = int(np.argmax(scores)) if candidates is None else int(candidates[np.argmax(scores[candidates])])
+        else:
+            # Inverse-CDF draw on unnormalized weights; no division by the total needed
+            if candidates is None:
+                cumulative = self._work
+                np.subtract(scores, scores.max(), out=cumulative)
+                np.exp(cumulative, out=cumulative)
+                np.cumsum(cumulative, out=cumulative)
+            else:
+                values = scores[candidates]
+                cumulative = np.cumsum(np.exp(values - values.max()))
+            index = min(int(np.searchsorted(cumulative, self.rng.random() * cumulative[-1], side="right")),
+                        cumulative.size - 1)
+            token = index if candidates is None else int(candidates[index])
+
+        self.elapsed_s += time.perf_counter() - start
+        self.calls += 1
+        return token
@@ -0,0 +1,207 @@
+"""
+Per-zone sharded threat analysis
+
+Partitions the alert window by zone (or by device when no zone map is given),
+analyzes quiet zones with the rule tier and hot zones with the LLM, then
+merges the results into one campus-level assessment.
+"""
+
+import time
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from anomaly_stats import format_anomaly_lines
+from npu_llm_engine import fallback_analysis
+
+THREAT_ORDER = ["LOW", "MEDIUM", "HIGH", "CRITICAL"]
+
+
+def threat_rank(level: str) -> int:
+    """Position of a threat level in THREAT_ORDER; unknown levels rank lowest"""
+    return THREAT_ORDER.index(level) if level in THREAT_ORDER else 0
+
+
+def verdict_counts(alert: Dict) -> Dict[str, int]:
+    """Alerts per verdict behind one entry (a burst cluster or a single alert)"""
+    counts = alert.get("verdictCounts")
+    if counts is None:
+        counts = {alert.get("operatorVerdict", "UNKNOWN"): alert.get("count", 1)}
+    return counts
+
+
+@lru_cache(maxsize=4096)
+def _alert_line(ts_ms: float, event_type: str, verdict: str, conf: float, device: str,
+                count: int, span_s: float, mean_conf: float, breakdown: tuple) -> str:
+    ts = datetime.fromtimestamp(ts_ms / 1000.0).strftime("%H:%M:%S")
+    line = (
+        f"- {ts} | {event_type} | Verdict: {verdict} | "
+        f"Confidence: {conf:.2f} | Device: {device}"
+    )
+
+    # Burst clusters collapse repeated frames into one line
+    if count > 1:
+        verdicts = ", ".join(f"{n} {v}" for v, n in breakdown)
+        line += f" | Burst: x{count} over {span_s:.0f}s ({verdicts}; mean conf {mean_conf:.2f})"
+
+    return line
+
+
+def format_alert_line(alert: Dict) -> str:
+    """Format one alert as a prompt line (memoized on the fields shown)"""
+    count = alert.get("count", 1)
+    return _alert_line(
+        alert["ts"],
+        alert["eventType"],
+        alert.get("operatorVerdict", "UNKNOWN"),
+        alert.get("modelConfidence", 0),
+        alert.get("deviceId", "unknown"),
+        count,
+        (alert["lastTs"] - alert["firstTs"]) / 1000.0 if count > 1 else 0.0,
+        alert["meanConfidence"] if count > 1 else 0.0,
+        tuple(verdict_counts(alert).items()) if count > 1 else (),
+    )
+
+
+def count_alerts(alerts: List[Dict]) -> int:
+    """Number of raw alerts, counting every frame in a burst cluster"""
+    return sum(a.get("count", 1) for a in alerts)
+
+
+def count_verdicts(alerts: List[Dict]) -> Tuple[int, int]:
+    """Return (YES count, MAYBE count) in raw alerts"""
+    yes_count = sum(verdict_counts(a).get("YES", 0) for a in alerts)
+    maybe_count = sum(verdict_counts(a).get("MAYBE", 0) for a in alerts)
+    return yes_count, maybe_count
+
+
+def zone_for_device(device_id: str, zone_map: Optional[Dict[str, str]] = None) -> str:
+    """Map a device to its zone; unmapped devices are their own zone"""
+    if zone_map and device_id in zone_map:
+        return zone_map[device_id]
+    return device_id
+
+
+def shard_alerts(alerts: List[Dict], zone_map: Optional[Dict[str, str]] = None) -> Dict[str, List[Dict]]:
+    """Group alerts by zone"""
+    shards: Dict[str, List[Dict]] = {}
+    for a in alerts:
+        zone = zone_for_device(a.get("deviceId", "unknown"), zone_map)
+        shards.setdefault(zone, []).append(a)
+    return shards
+
+
+def is_hot_shard(alerts: List[Dict], maybe_threshold: int = 2) -> bool:
+    """A shard needs the LLM if it has a confirmed threat or several uncertain ones"""
+    yes_count, maybe_count = count_verdicts(alerts)
+    return yes_count > 0 or maybe_count >= maybe_threshold
+
+
+def shard_anomaly_text(alerts: List[Dict], anomalies: Optional[List[Dict]]) -> str:
+    """Anomaly lines for the devices in this shard"""
+    devices = {a.get("deviceId", "unknown") for a in alerts}
+    return "\n".join(format_anomaly_lines([x for x in anomalies or [] if x["deviceId"] in devices]))
+
+
+def needs_llm(alerts: List[Dict], anomalies: Optional[List[Dict]] = None) -> bool:
+    return is_hot_shard(alerts) or bool(shard_anomaly_text(alerts, anomalies))
+
+
+def analyze_shard(engine, zone: str, alerts: List[Dict], lookback_minutes: int,
+                  anomalies: Optional[List[Dict]] = None, time_budget_s: Optional[float] = None,
+                  use_llm: bool = True) -> Dict:
+    """Analyze a single zone, using the LLM only for hot zones (and only if use_llm)"""
+    yes_count, maybe_count = count_verdicts(alerts)
+    total = count_alerts(alerts)
+    anomaly_text = shard_anomaly_text(alerts, anomalies)
+
+    if use_llm and (is_hot_shard(alerts) or anomaly_text):
+        alert_text = f"Zone: {zone}\n" + "\n".join(format_alert_line(a) for a in alerts)
+        result = engine.analyze_alerts(alert_text, yes_count, maybe_count, total, lookback_minutes,
+                                       anomaly_text=anomaly_text, time_budget_s=time_budget_s)
+    else:
+        result = fallback_analysis(yes_count, maybe_count, total, anomaly_text)
+
+    result["zone"] = zone
+    result["alerts"] = total
+    return result
+
+
+def merge_zone_results(results: List[Dict]) -> Dict:
+    """Combine per-zone assessments into one campus-level assessment"""
+    ranked = sorted(
+        results,
+        key=lambda r: (threat_rank(r.get("threat_level", "LOW")), r["alerts"]),
+        reverse=True
+    )
+    hottest = ranked[0]
+    elevated = [r for r in ranked if r["threat_level"] != "LOW"]
+
+    if elevated:
+        summary = (
+            f"{len(elevated)} of {len(ranked)} zones elevated. "
+            f"Highest: {hottest['zone']} ({hottest['threat_level']}) - {hottest['summary']}"
+        )
+    else:
+        summary = f"All {len(ranked)} zones quiet. {hottest['summary']}"
+
+    # Recommendations from the most severe zones first, de-duplicated
+    recommendations = []
+    for r in elevated or ranked[:1]:
+        for rec in r.get("recommendations", []):
+            line = f"[{r['zone']}] {rec}" if len(ranked) > 1 else rec
+            if line not in recommendations:
+                recommendations.append(line)
+    recommendations = recommendations[:5]
+
+    return {
+        "threat_level": hottest["threat_level"],
+        "summary": summary,
+        "recommendations": recommendations,
+        "alert_security": any(r.get("alert_security") for r in ranked),
+        "npu_processed": any(r.get("npu_processed") for r in ranked),
+        "zones": {
+            r["zone"]: {
+                "threat_level": r["threat_level"],
+                "alerts": r["alerts"],
+                "summary": r["summary"],
+                "npu_processed": r.get("npu_processed", False),
+            }
+            for r in ranked
+        },
+    }
+
+
+def analyze_alerts_sharded(engine, alerts: List[Dict], lookback_minutes: int,
+                           zone_map: Optional[Dict[str, str]] = None,
+                           anomalies: Optional[List[Dict]] = None, time_budget_s: Optional[float] = None) -> Dict:
+    """
+    Analyze each zone and merge into a campus-level assessment.
+
+    Quiet zones go straight to the rule tier. Hot zones share the one model,
+    so they run one at a time, most severe first, each getting an equal
+    share of the time left. Running them side by side would only slow every
+    run down and teach the throughput tracker the contended speed.
+    """
+    shards = shard_alerts(alerts, zone_map)
+    hot = [zone for zone, zone_alerts in shards.items() if needs_llm(zone_alerts, anomalies)]
+    hot.sort(key=lambda zone: (*count_verdicts(shards[zone]), count_alerts(shards[zone])), reverse=True)
+
+    results = [
+        analyze_shard(engine, zone, zone_alerts, lookback_minutes, anomalies, use_llm=False)
+        for zone, zone_alerts in shards.items() if zone not in hot
+    ]
+
+    deadline = time.time() + time_budget_s if time_budget_s else None
+    for i, zone in enumerate(hot):
+        budget = None
+        if deadline is not None:
+            budget = (deadline - time.time()) / (len(hot) - i)
+        # Out of time: the remaining hot zones get the rule tier
+        use_llm = budget is None or budget > 0
+        results.append(analyze_shard(engine, zone, shards[zone], lookback_minutes, anomalies, budget, use_llm))
+
+    print(f"🗺️  Sharded analysis: {len(results)} zones, "
+          f"{sum(1 for r in results if r.get('npu_processed'))} on NPU")
+
+    return merge_zone_results(results)
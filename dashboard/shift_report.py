@@ -0,0 +1,357 @@
+"""
+Offline shift / weekly incident reports over archived alerts
+
+Streams an alert archive (JSONL: one alert per line, or saved /alerts
+responses, one {"alerts": [...]} per line), slices it into fixed time
+windows and analyzes each window with NPU_LLM_Engine.analyze_alerts on a
+pool of engine processes. Every finished window is appended to the output
+JSONL right away, so an interrupted run resumes where it stopped. A
+rolled-up Markdown report is written at the end.
+
+    python shift_report.py alerts.jsonl -o shift.jsonl --window-minutes 60
+    python shift_report.py archive/*.jsonl.gz -o week.jsonl --report week.md
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from alert_clusters import cluster_alerts
+from anomaly_stats import StreamingAnomalyStats, format_anomaly_lines
+from sharded_analysis import THREAT_ORDER, count_verdicts, format_alert_line, threat_rank
+
+# Rough per-engine footprint (int4 weights, KV cache, runtime) and the threads one engine uses well
+ENGINE_MEMORY_BYTES = 3 * 1024 ** 3
+THREADS_PER_ENGINE = 4
+
+# Windows are only closed once the stream has moved this many windows past them
+LATENESS_WINDOWS = 1
+
+_engine = None
+
+
+def default_workers() -> int:
+    """Engine processes this host can run side by side (CPU and RAM bound)"""
+    cpus = os.cpu_count() or 1
+    by_cpu = max(1, cpus // THREADS_PER_ENGINE)
+    try:
+        by_mem = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // ENGINE_MEMORY_BYTES
+    except (AttributeError, ValueError, OSError):
+        # No sysconf (Windows): trust the CPU bound
+        by_mem = by_cpu
+    return max(1, min(by_cpu, by_mem))
+
+
+def iter_alerts(paths: List[Path], stats: Counter) -> Iterator[Dict]:
+    """Yield alerts one at a time from JSONL files (optionally gzipped)"""
+    for path in paths:
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    stats["malformed"] += 1
+                    continue
+
+                for alert in record.get("alerts", [record]):
+                    if "ts" in alert and "eventType" in alert:
+                        yield alert
+                    else:
+                        stats["malformed"] += 1
+
+
+def _alert_key(alert: Dict):
+    return alert.get("id") or (alert["ts"], alert.get("deviceId"), alert["eventType"])
+
+
+def iter_windows(alerts: Iterator[Dict], window_ms: int, stats: Counter) -> Iterator[Tuple[int, List[Dict]]]:
+    """
+    Group a roughly time-ordered stream into (window index, alerts) in order.
+
+    Only the newest LATENESS_WINDOWS + 1 windows are held in memory. Alerts
+    are de-duplicated by id within a window (saved /alerts snapshots overlap);
+    alerts for a window that was already closed are counted and dropped.
+    """
+    open_windows: Dict[int, Dict] = {}
+    newest = None
+
+    for alert in alerts:
+        w = int(alert["ts"] // window_ms)
+        if newest is not None and w < newest - LATENESS_WINDOWS:
+            stats["late"] += 1
+            continue
+
+        bucket = open_windows.setdefault(w, {})
+        key = _alert_key(alert)
+        if key in bucket:
+            stats["duplicates"] += 1
+        bucket[key] = alert
+
+        if newest is None or w > newest:
+            newest = w
+            for closed in sorted(k for k in open_windows if k < newest - LATENESS_WINDOWS):
+                yield closed, list(open_windows.pop(closed).values())
+
+    for closed in sorted(open_windows):
+        yield closed, list(open_windows.pop(closed).values())
+
+
+def iter_records(output: Path, window_minutes: int) -> Iterator[Dict]:
+    """
+    Window records in the output file that were analyzed with this window
+    length. Records from runs with another --window-minutes are skipped.
+    """
+    mismatched = 0
+    with open(output, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A run killed mid-write leaves a partial last line; that window is redone
+                continue
+            if record.get("window_minutes") != window_minutes:
+                mismatched += 1
+                continue
+            yield record
+
+    if mismatched:
+        print(f"⚠️  Ignoring {mismatched} records in {output} that were not made with {window_minutes}-minute windows")
+
+
+def load_checkpoint(output: Path, window_minutes: int) -> Set[int]:
+    """Window start times (ms) already in the output file for this window length"""
+    if not output.exists():
+        return set()
+    return {record["window_start"] for record in iter_records(output, window_minutes) if "window_start" in record}
+
+
+def _init_worker(intra_op_threads: int):
+    """Process pool initializer: each worker loads its own engine once"""
+    global _engine
+    from npu_llm_engine import NPU_LLM_Engine
+
+    _engine = NPU_LLM_Engine(intra_op_threads=intra_op_threads)
+
+
+def _analyze_window(job: Dict) -> Dict:
+    start = time.time()
+    analysis = _engine.analyze_alerts(
+        job.pop("alert_text"),
+        job["yes"],
+        job["maybe"],
+        job["total"],
+        job["window_minutes"],
+        anomaly_text=job.pop("anomaly_text"),
+    )
+    job["analysis"] = analysis
+    job["elapsed_s"] = round(time.time() - start, 2)
+    return job
+
+
+def build_job(window_start: int, window_ms: int, alerts: List[Dict], anomaly_stats: StreamingAnomalyStats,
+              burst_gap_s: float) -> Dict:
+    """Prepare one window the same way the live dashboard prepares its lookback"""
+    alerts.sort(key=lambda a: a["ts"])
+    window_end = window_start + window_ms
+
+    # Baselines carry across windows, so a device is compared to its own history
+    anomaly_stats.update_many(alerts)
+    anomalies = anomaly_stats.top_anomalies(window_end / 1000.0)
+
+    clusters = cluster_alerts(alerts, gap_s=burst_gap_s)
+    yes_count, maybe_count = count_verdicts(clusters)
+
+    devices = Counter()
+    for c in clusters:
+        devices[c.get("deviceId", "unknown")] += c["count"]
+
+    return {
+        "window_start": window_start,
+        "window_end": window_end,
+        "window_minutes": window_ms // 60000,
+        "total": len(alerts),
+        "bursts": len(clusters),
+        "yes": yes_count,
+        "maybe": maybe_count,
+        "devices": dict(devices.most_common(5)),
+        "anomalies": len(anomalies),
+        "alert_text": "\n".join(format_alert_line(c) for c in clusters),
+        "anomaly_text": "\n".join(format_anomaly_lines(anomalies)),
+    }
+
+
+def run_windows(paths: List[Path], output: Path, window_minutes: int, workers: int, burst_gap_s: float) -> Counter:
+    """Analyze every window not yet in `output`, appending results as they finish"""
+    window_ms = window_minutes * 60000
+    stats = Counter()
+    done = load_checkpoint(output, window_minutes)
+    if done:
+        print(f"↻ Resuming: {len(done)} windows already in {output}")
+
+    anomaly_stats = StreamingAnomalyStats()
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    max_in_flight = workers * 2
+
+    print(f"🧠 Analyzing {window_minutes}-minute windows with {workers} engine processes ({threads} threads each)...")
+    started = time.time()
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "a+", encoding="utf-8") as out, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(threads,)) as pool:
+        # Don't glue the first new record onto a partial line from a killed run
+        if out.tell() > 0:
+            out.seek(out.tell() - 1)
+            if out.read(1) != "\n":
+                out.write("\n")
+
+        def drain(pending, block_until: int):
+            while len(pending) > block_until:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record = future.result()
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+                    os.fsync(out.fileno())
+                    stats["analyzed"] += 1
+                    ts = datetime.fromtimestamp(record["window_start"] / 1000.0).strftime("%Y-%m-%d %H:%M")
+                    print(f"  ✓ {ts} | {record['total']} alerts | "
+                          f"{record['analysis'].get('threat_level', 'UNKNOWN')} | {record['elapsed_s']:.1f}s")
+            return pending
+
+        pending = set()
+        for w, alerts in iter_windows(iter_alerts(paths, stats), window_ms, stats):
+            window_start = w * window_ms
+            if window_start in done:
+                # Still fold the alerts into the baselines so later windows see the same history
+                anomaly_stats.update_many(alerts)
+                stats["skipped"] += 1
+                continue
+
+            # Bounded in-flight work keeps memory flat however long the archive is
+            pending = drain(pending, max_in_flight - 1)
+            pending.add(pool.submit(_analyze_window, build_job(window_start, window_ms, alerts, anomaly_stats,
+                                                               burst_gap_s)))
+
+        drain(pending, 0)
+
+    print(f"✅ {stats['analyzed']} windows analyzed in {time.time() - started:.0f}s "
+          f"({stats['skipped']} resumed, {stats['late']} late, {stats['duplicates']} duplicate, "
+          f"{stats['malformed']} malformed records)")
+    return stats
+
+
+def _fmt_ms(ts_ms: int) -> str:
+    return datetime.fromtimestamp(ts_ms / 1000.0).strftime("%Y-%m-%d %H:%M")
+
+
+def build_report(output: Path, window_minutes: int) -> str:
+    """Roll the per-window assessments in `output` up into one Markdown report"""
+    records = []
+    for record in iter_records(output, window_minutes):
+        # Keep only what the report needs; the full record stays in the JSONL
+        analysis = record["analysis"]
+        records.append({
+            "window_start": record["window_start"],
+            "window_end": record["window_end"],
+            "total": record["total"],
+            "bursts": record["bursts"],
+            "yes": record["yes"],
+            "maybe": record["maybe"],
+            "devices": record.get("devices", {}),
+            "threat_level": analysis.get("threat_level", "LOW"),
+            "summary": analysis.get("summary", ""),
+            "recommendations": analysis.get("recommendations", []),
+            "npu_processed": analysis.get("npu_processed", False),
+        })
+
+    if not records:
+        return "# CampusGuard Incident Report\n\nNo alerts in the selected archive.\n"
+
+    records.sort(key=lambda r: r["window_start"])
+    levels = Counter(r["threat_level"] for r in records)
+    devices = Counter()
+    recommendations = Counter()
+    for r in records:
+        devices.update(r["devices"])
+        if r["threat_level"] != "LOW":
+            recommendations.update(r["recommendations"])
+
+    peak = max(records, key=lambda r: (threat_rank(r["threat_level"]), r["yes"], r["total"]))
+    elevated = [r for r in records if r["threat_level"] != "LOW"]
+
+    lines = [
+        "# CampusGuard Incident Report",
+        "",
+        f"**Period:** {_fmt_ms(records[0]['window_start'])} → {_fmt_ms(records[-1]['window_end'])}  ",
+        f"**Highest threat:** {peak['threat_level']} ({_fmt_ms(peak['window_start'])})  ",
+        f"**Windows with alerts:** {len(records)} "
+        f"({sum(r['npu_processed'] for r in records)} LLM, {sum(not r['npu_processed'] for r in records)} rule-based)  ",
+        f"**Alerts:** {sum(r['total'] for r in records)} in {sum(r['bursts'] for r in records)} bursts "
+        f"({sum(r['yes'] for r in records)} confirmed, {sum(r['maybe'] for r in records)} uncertain)",
+        "",
+        "## Threat levels",
+        "",
+        "| Level | Windows |",
+        "|---|---|",
+    ]
+    lines += [f"| {level} | {levels[level]} |" for level in reversed(THREAT_ORDER) if levels[level]]
+
+    lines += ["", "## Incident timeline", ""]
+    if elevated:
+        lines += ["| Window | Level | Alerts | Summary |", "|---|---|---|---|"]
+        for r in elevated:
+            summary = r["summary"].replace("|", "/").replace("\n", " ")
+            lines.append(f"| {_fmt_ms(r['window_start'])} | {r['threat_level']} | {r['total']} ({r['yes']} YES) | {summary} |")
+    else:
+        lines.append("No elevated windows.")
+
+    lines += ["", "## Busiest devices", ""]
+    lines += [f"- {device}: {count} alerts" for device, count in devices.most_common(5)]
+
+    if recommendations:
+        lines += ["", "## Recurring recommendations", ""]
+        lines += [f"- {rec} ({count}×)" for rec, count in recommendations.most_common(5)]
+
+    return "\n".join(lines) + "\n"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Batch shift/weekly incident reports from archived alerts")
+    parser.add_argument("inputs", nargs="+", type=Path, help="alert archives (.jsonl or .jsonl.gz), in time order")
+    parser.add_argument("-o", "--output", type=Path, required=True,
+                        help="per-window results (JSONL); also the resume checkpoint")
+    parser.add_argument("--report", type=Path, help="rolled-up Markdown report (default: <output>.md)")
+    parser.add_argument("--window-minutes", type=int, default=60, help="analysis window length")
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="engine processes (default for this host: %(default)s)")
+    parser.add_argument("--burst-gap", type=float, default=10.0, help="seconds between alerts of one burst")
+    args = parser.parse_args(argv)
+
+    try:
+        run_windows(args.inputs, args.output, args.window_minutes, args.workers, args.burst_gap)
+    except BrokenProcessPool:
+        print("❌ An engine process died (is the model provisioned? run download_llm.py). "
+              "Finished windows are saved; rerun the same command to resume.")
+        return 1
+
+    report_path = args.report or args.output.with_suffix(".md")
+    report_path.write_text(build_report(args.output, args.window_minutes), encoding="utf-8")
+    print(f"📝 Report written to {report_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""
+Token-space prompt assembly
+
+Prompts are mostly the same lines tick after tick: the fixed template and
+alert lines that haven't changed. Each line is tokenized once, as it
+tokenizes in the middle of a prompt right after a newline. This is done by
+tokenizing it behind a "\\n" anchor and dropping the anchor's tokens. The
+result is kept in a bounded LRU, so a prompt becomes a concatenation of
+cached arrays. Alert lines are cached under the caller's key (the alert id
+in incremental analysis, the line text itself where no id is passed) and
+re-tokenized only when their text changes.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+import numpy as np
+
+ANCHOR = "\n"
+
+KeyedLine = Tuple[str, str]
+
+
+class PromptTokenCache:
+    def __init__(self, tokenizer, max_entries: int = 4096):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self._anchor_ids = self._encode(ANCHOR, add_special_tokens=False)
+        self._cache: "OrderedDict[tuple, Tuple[str, np.ndarray]]" = OrderedDict()
+        # Prompts are built from several threads (sharded analysis, worker connections)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _encode(self, text: str, add_special_tokens: bool) -> np.ndarray:
+        return np.asarray(
+            self.tokenizer(text, add_special_tokens=add_special_tokens)["input_ids"], dtype=np.int64
+        ).reshape(-1)
+
+    def _unit(self, text: str) -> np.ndarray:
+        """Tokens of `text` where it follows a newline"""
+        ids = self._encode(ANCHOR + text, add_special_tokens=False)
+        n = self._anchor_ids.size
+        if ids.size >= n and np.array_equal(ids[:n], self._anchor_ids):
+            return ids[n:]
+        # The anchor merged into the text; the caller's check against full tokenization will notice
+        return self._encode(text, add_special_tokens=False)
+
+    def _cached(self, key: tuple, text: str, encode) -> np.ndarray:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] == text:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Tokenize outside the lock; a concurrent miss on the same key just stores equal ids
+        ids = encode(text)
+        with self._lock:
+            self._cache[key] = (text, ids)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return ids
+
+    def _continuation(self, text: str) -> List[np.ndarray]:
+        """Template text that follows a newline, one cached unit per line"""
+        return [self._cached(("text", line), line, self._unit) for line in text.splitlines(keepends=True)]
+
+    def assemble(self, parts: List[str], groups: List[List[KeyedLine]], add_special_tokens: bool = True) -> np.ndarray:
+        """
+        Token ids (1, n) of parts[0] + "\\n".join(lines of groups[0]) + parts[1] + ...
+
+        Every part before a non-empty group must end with a newline and every
+        part after one must start with a newline, so lines stay whole.
+        """
+        start = parts[0]
+        ids = [self._cached(("start", add_special_tokens, start), start,
+                            lambda text: self._encode(text, add_special_tokens))]
+
+        for group, part in zip(groups, parts[1:]):
+            if group:
+                # Each alert line carries its newline; the template's leading one is already in it
+                ids.extend(self._cached(("line", key), line + "\n", self._unit) for key, line in group)
+                part = part[1:]
+            ids.extend(self._continuation(part))
+
+        return np.concatenate(ids)[None, :]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._cache), "hits": self.hits, "misses": self.misses}